@@ -0,0 +1,55 @@
+#!/usr/bin/python
+
+# Plays a capture recorded by a 'capture' endpoint (see capture.py) back
+# into comm_router.py: every chunk is sent as a datagram to a udp endpoint
+# of the router, with its original timing, sped up or slowed down, or as
+# fast as the socket takes it to load test the router.
+
+import argparse
+import socket
+import sys
+import time
+
+import capture
+
+parser = argparse.ArgumentParser(description="Replay a router capture")
+parser.add_argument('--capture', action="store", type=str, required=True, help="capture path (as in the capture endpoint) or a single .cap segment")
+parser.add_argument('--ip', action="store", type=str, default="127.0.0.1", help="udp destination ip address")
+parser.add_argument('--port', action="store", type=int, default=14550, help="udp destination port")
+parser.add_argument('--speed', action="store", type=float, default=1.0, help="playback speed, 2 for twice as fast, 0 for as fast as possible")
+parser.add_argument('--start', action="store", type=float, default=0.0, help="seconds into the capture to start from")
+parser.add_argument('--loop', action="store_true", help="start over at the end")
+args = parser.parse_args()
+
+reader = capture.Reader(args.capture)
+first = reader.start()
+if first is None:
+    print 'nothing captured in %s' % args.capture
+    sys.exit(1)
+
+sockit = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+while True:
+    sent = 0
+    size = 0
+    begin = None
+    clock = time.time()
+
+    for when, data in reader.records(first + args.start):
+        if begin is None:
+            begin = when
+        if args.speed > 0:
+            delay = (when - begin) / args.speed - (time.time() - clock)
+            if delay > 0:
+                time.sleep(delay)
+        try:
+            sockit.sendto(data, (args.ip, args.port))
+            sent += 1
+            size += len(data)
+        except Exception as e:
+            print e
+
+    elapsed = time.time() - clock
+    print 'replayed %d chunks, %d bytes in %.1f s' % (sent, size, elapsed)
+    if not args.loop:
+        break
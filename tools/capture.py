@@ -0,0 +1,309 @@
+#!/usr/bin/python
+
+import bisect
+import errno
+import glob
+import os
+import struct
+import threading
+import zlib
+
+# at the start of every segment file
+MAGIC = b'RCAP\x01\x00\x00\x00'
+
+# blocks of records: time of the first record, bytes stored, bytes of
+# records once decompressed, flags
+BLOCK = struct.Struct('<dIIB')
+COMPRESSED = 1
+
+# every chunk is stored with the time it was routed and its length
+RECORD = struct.Struct('<dI')
+
+# one index entry per block: time of its first record, offset in the segment
+INDEX = struct.Struct('<dQ')
+
+# records are written out in blocks of about this many bytes
+BLOCK_SIZE = 65536
+
+# longest records wait before they are written out (seconds)
+FLUSH_INTERVAL = 0.5
+
+# a new segment is started once one grows past this many bytes
+SEGMENT_SIZE = 16 * 1024 * 1024
+
+# most bytes of records held in memory while the disk catches up, more is
+# dropped instead of holding up the router
+QUEUE_SIZE = 4 * 1024 * 1024
+
+# zlib level of compressed captures, cheap rather than small
+COMPRESS_LEVEL = 1
+
+
+# segment files of a capture, oldest first
+def segments(prefix):
+	return sorted(glob.glob(prefix + '-*.cap'))
+
+
+# the sequence number of a segment file
+def number(filename):
+	return int(filename[:-len('.cap')].rsplit('-', 1)[1])
+
+
+# appends every chunk it is given, with the time, to an append-only capture:
+# numbered segment files (prefix-000001.cap...) and a sparse time index of
+# each (.cap.idx) for replay to seek with. The router only copies chunks to
+# memory, a background thread does the writing, compression and rotation
+class Writer(object):
+
+	def __init__(self, prefix, segment=SEGMENT_SIZE, keep=0, compress=False):
+		self.prefix = prefix
+		self.segment = segment
+		# segments kept, the oldest are deleted, 0 keeps all of them
+		self.keep = keep
+		self.compress = compress
+
+		directory = os.path.dirname(os.path.abspath(prefix))
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		existing = segments(prefix)
+		self.number = number(existing[-1]) if existing else 0
+		self.file = None
+		self.index = None
+
+		# records not handed to the thread yet, and the time of the first
+		self.records = bytearray()
+		self.first = 0
+		# (time of the first record, records) blocks waiting to be written
+		self.blocks = []
+		self.queued = 0
+		# bytes of records dropped: queue full, or the disk failed
+		self.drops = 0
+		self.running = True
+		self.condition = threading.Condition()
+
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+
+	def write(self, data, now):
+		with self.condition:
+			if self.queued + len(self.records) + RECORD.size + len(data) > QUEUE_SIZE:
+				self.drops += len(data)
+				return
+			if not self.records:
+				self.first = now
+			self.records += RECORD.pack(now, len(data))
+			self.records += data
+			if len(self.records) >= BLOCK_SIZE:
+				self.seal()
+				self.condition.notify()
+
+
+	# hand the records so far to the thread as a block
+	def seal(self):
+		self.blocks.append((self.first, self.records))
+		self.queued += len(self.records)
+		self.records = bytearray()
+
+
+	def run(self):
+		while True:
+			with self.condition:
+				if not self.blocks and self.running:
+					self.condition.wait(FLUSH_INTERVAL)
+				if self.records:
+					self.seal()
+				blocks = self.blocks
+				self.blocks = []
+				running = self.running
+
+			for first, records in blocks:
+				try:
+					self.store(first, records)
+					lost = 0
+				except Exception as e:
+					print("Error writing capture %s: %s") % (self.prefix, e)
+					lost = len(records)
+					# the next block starts a new segment
+					if self.file is not None:
+						self.finish()
+				with self.condition:
+					self.queued -= len(records)
+					self.drops += lost
+
+			if not running:
+				break
+
+		if self.file is not None:
+			self.finish()
+
+
+	def store(self, first, records):
+		if self.file is None or self.file.tell() >= self.segment:
+			self.rotate()
+
+		data = bytes(records)
+		flags = 0
+		if self.compress:
+			data = zlib.compress(data, COMPRESS_LEVEL)
+			flags |= COMPRESSED
+
+		offset = self.file.tell()
+		self.file.write(BLOCK.pack(first, len(data), len(records), flags))
+		self.file.write(data)
+		self.file.flush()
+		self.index.write(INDEX.pack(first, offset))
+		self.index.flush()
+
+
+	# close the current segment, if any, and start the next one
+	def rotate(self):
+		if self.file is not None:
+			self.finish()
+
+		# never over an existing segment: a writer that was stopped (the
+		# endpoint was removed or replaced) may still be finishing its last
+		# one next to ours
+		while True:
+			self.number += 1
+			filename = '%s-%06d.cap' % (self.prefix, self.number)
+			try:
+				fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+				break
+			except OSError as e:
+				if e.errno != errno.EEXIST:
+					raise
+		self.file = os.fdopen(fd, 'wb')
+		self.file.write(MAGIC)
+		self.index = open(filename + '.idx', 'wb')
+
+		if self.keep:
+			for old in segments(self.prefix)[:-self.keep]:
+				for name in (old, old + '.idx'):
+					try:
+						os.unlink(name)
+					except OSError as e:
+						pass
+
+
+	def finish(self):
+		for f in (self.file, self.index):
+			try:
+				f.flush()
+				os.fsync(f.fileno())
+				f.close()
+			except Exception as e:
+				pass
+		self.file = None
+		self.index = None
+
+
+	# write out what is left and stop, in the background: the last write and
+	# the fsync are not waited for, the router calls this
+	def stop(self):
+		with self.condition:
+			self.running = False
+			self.condition.notify()
+
+
+	# write out what is left and stop
+	def close(self):
+		self.stop()
+		self.thread.join()
+
+
+# the records of a capture, as (time, data), in the order they were written
+#
+#	for when, data in capture.Reader('/home/pi/captures/dive').records(start):
+#		...
+class Reader(object):
+
+	def __init__(self, prefix):
+		self.files = segments(prefix)
+		if not self.files and os.path.isfile(prefix):
+			# a single segment
+			self.files = [prefix]
+
+
+	# time of the first record, None for an empty capture
+	def start(self):
+		for filename in self.files:
+			for first, offset in self.blocks(filename):
+				return first
+		return None
+
+
+	# (time of the first record, offset) of every block in a segment, from
+	# its index, or from the block headers if the index is missing or was
+	# cut short
+	def blocks(self, filename):
+		entries = []
+		try:
+			f = open(filename + '.idx', 'rb')
+			data = f.read()
+			f.close()
+			for i in range(len(data) // INDEX.size):
+				entries.append(INDEX.unpack_from(data, i * INDEX.size))
+		except IOError as e:
+			pass
+
+		offset = entries[-1][1] if entries else len(MAGIC)
+		f = open(filename, 'rb')
+		try:
+			size = os.fstat(f.fileno()).st_size
+			if entries:
+				# the last indexed block, where the scan picks up
+				f.seek(offset)
+				header = f.read(BLOCK.size)
+				if len(header) < BLOCK.size:
+					return entries[:-1]
+				offset += BLOCK.size + BLOCK.unpack(header)[1]
+			while offset + BLOCK.size <= size:
+				f.seek(offset)
+				first, length, raw, flags = BLOCK.unpack(f.read(BLOCK.size))
+				if offset + BLOCK.size + length > size:
+					break
+				entries.append((first, offset))
+				offset += BLOCK.size + length
+		finally:
+			f.close()
+		return entries
+
+
+	# records from the block holding start on (seconds since the epoch,
+	# None for all of them)
+	def records(self, start=None):
+		segments = [(filename, self.blocks(filename)) for filename in self.files]
+		segments = [(filename, entries) for filename, entries in segments if entries]
+
+		# skip the segments that end before start
+		if start is not None:
+			firsts = [entries[0][0] for filename, entries in segments]
+			segments = segments[max(0, bisect.bisect_right(firsts, start) - 1):]
+
+		for filename, entries in segments:
+			i = 0
+			if start is not None:
+				i = max(0, bisect.bisect_right([first for first, offset in entries], start) - 1)
+
+			f = open(filename, 'rb')
+			try:
+				for first, offset in entries[i:]:
+					f.seek(offset)
+					first, length, raw, flags = BLOCK.unpack(f.read(BLOCK.size))
+					data = f.read(length)
+					if len(data) < length:
+						break
+					if flags & COMPRESSED:
+						data = zlib.decompress(data)
+
+					position = 0
+					while position + RECORD.size <= len(data):
+						when, n = RECORD.unpack_from(data, position)
+						position += RECORD.size
+						if start is None or when >= start:
+							yield when, data[position:position + n]
+						position += n
+			finally:
+				f.close()
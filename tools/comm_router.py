@@ -1,84 +1,346 @@
 #!/usr/bin/python
 
+import os
+import select
 import socket
-import time
 import json
+import threading
+import time
 import endpoint
+import filters
+import inotify
+import latency
+import persist
+import router
+import shard
 
 debug = False
 
+# where the configuration lives, saved after every change
+CONFIGURATION = '/home/pi/routing.conf'
+
 # load configuration from file
 try:
     print 'loading configuration from file...'
-    endpoint.load('/home/pi/routing.conf')
+    endpoint.load(CONFIGURATION)
     print 'configuration successfully loaded'
 except Exception as e:
     print 'error loading configuration'
     print e
     pass
 
-# we will listen here for requests
+# we will listen here for requests, on the control thread
 sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock.setblocking(False)
 sock.bind(('0.0.0.0', 18990))
 
-while True:
-    # don't hog the cpu
-    time.sleep(0.01)
-    
-    # read all endpoints and write all routes
-    for _endpoint in endpoint.endpoints:
-        _endpoint.read()
-        
+# stats streams end unless they are requested again within this long (seconds)
+STREAM_TIMEOUT = 30.0
+
+# address -> [interval, next send, time the stream ends] for every stats
+# stream. They are sent from the control thread, reading the counters costs
+# the forwarding loop nothing
+streams = {}
+
+
+# send the endpoint counters, once or every interval seconds. An interval
+# of 0 stops the stream
+def send_stats(address, interval=None):
+    sock.sendto(json.dumps({"stats": endpoint.stats()}), address)
+    if interval is None:
+        return
+
+    # a new request replaces the stream to that address
+    streams.pop(address, None)
+    if interval > 0:
+        now = time.time()
+        streams[address] = [interval, now + interval, now + STREAM_TIMEOUT]
+
+
+# send the streams that are due, returns how long until the next one is
+# (None if there are no streams)
+def stream_stats():
+    now = time.time()
+    for address, stream in streams.items():
+        if now > stream[2]:
+            del streams[address]
+            continue
+        if now < stream[1]:
+            continue
+        # a late send doesn't cause a burst of them
+        stream[1] = max(stream[1] + stream[0], now)
+        # an endpoint closing under us, the next round will do
+        try:
+            data = json.dumps({"stats": endpoint.stats()})
+        except Exception as e:
+            print("Error reading stats: %s") % e
+            continue
+        # the receiver is gone
+        try:
+            sock.sendto(data, address)
+        except socket.error as e:
+            print("Error streaming stats to %s: %s") % (address, e)
+            del streams[address]
+
+    if not streams:
+        return None
+    return max(0, min(stream[1] for stream in streams.values()) - time.time())
+
+
+# requests that change the endpoints or routes
+topology_requests = ['add endpoint', 'remove endpoint', 'connect endpoints',
+                     'disconnect endpoints', 'load all', 'batch']
+
+# saves happen in the background, never in the way of forwarding
+persister = persist.Persister(CONFIGURATION)
+
+# endpoints handed over to the forwarding loop of the main process
+deployed = set()
+
+
+# hand the current topology over to the forwarding loop. It gets a snapshot
+# of the routes that it switches to in one go, between two rounds of
+# forwarding, and closes the endpoints that are gone. update is (endpoint,
+# entry) for endpoints that take new options, without the ids of endpoints
+# to close even though they are still configured, wait until the loop is done
+def deploy(update=(), wait=False, without=()):
+    endpoints = [_endpoint for _endpoint in endpoint.endpoints if _endpoint.id not in without]
+    routes = endpoint.routes(endpoints)
+    for loop in endpoint.loops(routes):
+        print("routing loop: %s") % ' -> '.join(loop)
+
+    # open new serial ports (and tcp clients) here rather than in the loop.
+    # Only those of the main process: a worker shard opens its own after it
+    # starts, what it would inherit from here is never polled in time
+    moving = dict((_endpoint, int(endpoint_json.get('shard', 0)))
+                  for _endpoint, endpoint_json in update)
+    local = [_endpoint for _endpoint in endpoints
+             if moving.get(_endpoint, _endpoint.shard) == 0]
+    for _endpoint in local:
+        if _endpoint not in deployed and hasattr(_endpoint, 'open'):
+            _endpoint.open()
+    deployed.clear()
+    deployed.update(local)
+
+    done = threading.Event()
+
+    def switch():
+        for _endpoint, endpoint_json in update:
+            previous = _endpoint.to_json()
+            try:
+                _endpoint.configure(endpoint_json)
+            except Exception as e:
+                # back to the options it had, not half of the new ones
+                print("Error configuring %s: %s") % (_endpoint.id, e)
+                try:
+                    _endpoint.configure(previous)
+                except Exception as e:
+                    print("Error restoring %s: %s") % (_endpoint.id, e)
+        shards.start(endpoints, routes)
+        done.set()
+
+    _router.call(switch)
+    if wait:
+        done.wait()
+
+
+# switch to a new configuration, only the endpoints that changed are closed
+# and opened again, the others keep forwarding throughout. A configuration
+# that doesn't check out, or an endpoint that can't be created, raises and
+# changes nothing
+def reload(configuration):
+    endpoint.check(configuration)
+    remove, create, update = endpoint.diff(configuration)
+
+    # endpoints that are replaced must be closed before the new ones bind,
+    # they are opened again if the new ones can't be created
+    released = [endpoint.get(endpoint_id) for endpoint_id in remove]
+    if remove:
+        deploy(without=remove, wait=True)
+    try:
+        created = endpoint.build(create)
+    except Exception as e:
+        for _endpoint in released:
+            endpoint.restore(_endpoint)
+        deploy()
+        raise
+
+    for endpoint_id in remove:
+        endpoint.remove(endpoint_id)
+    for _endpoint in created:
+        endpoint.add(_endpoint)
+
+    for endpoint_json in configuration['endpoints']:
+        _endpoint = endpoint.get(endpoint_json['id'])
+        if _endpoint is not None and _endpoint.connections_json() != endpoint_json['connections']:
+            _endpoint.set_connections(endpoint_json['connections'])
+
+    deploy(update)
+    print("reloaded: %d removed, %d created, %d updated") % (
+        len(remove), len(create), len(update))
+
+
+# the configuration file was written, by us or by someone editing it
+def handle_change():
+    try:
+        events = watcher.read()
+    except OSError as e:
+        print("Error watching %s: %s") % (CONFIGURATION, e)
+        return
+    if os.path.basename(CONFIGURATION) not in [name for path, mask, name in events]:
+        return
+
     try:
-        # see if there is a new request
-        data, address = sock.recvfrom(1024)
+        f = open(CONFIGURATION, 'r')
+        data = f.read()
+        f.close()
+    except IOError as e:
+        return
+
+    # our own save
+    if data == persister.written:
+        return
+
+    try:
+        configuration = json.loads(data)
+        configuration['endpoints']
+    # half written by an editor, the next write will complete it
+    except Exception as e:
+        print("Error reading %s: %s") % (CONFIGURATION, e)
+        return
+
+    print("%s changed") % CONFIGURATION
+    try:
+        reload(configuration)
+    except Exception as e:
+        print("Error reloading %s: %s") % (CONFIGURATION, e)
+
+
+def handle_request():
+    try:
+        # see if there is a new request, batches can be big
+        data, address = sock.recvfrom(65535)
         print("\n%s sent %s\n") % (address, data)
-        
+
         # all requests come packed in json
         msg = json.loads(data)
-        
+
         try:
             request = msg['request']
             print("Got request %s") % request
         except:
             print "No request!"
-            continue
-        
+            return
+
         if request == 'add endpoint':
             endpoint.add(endpoint.from_json(msg))
-            
+
         elif request == 'remove endpoint':
             endpoint.remove(msg['id'])
             sock.sendto(endpoint.to_json(), address)
-            
+
         elif request == 'connect endpoints':
             print('got connect request: %s') % data
-            endpoint.connect(msg['source'], msg['target'])
-            
+            endpoint.connect(msg['source'], msg['target'], filters.settings(msg))
+
         elif request == 'disconnect endpoints':
             endpoint.disconnect(msg['source'], msg['target'])
-            
+
+        # a list of the requests above, applied all together or not at all
+        elif request == 'batch':
+            try:
+                endpoint.apply(msg['operations'],
+                               lambda ids: deploy(without=ids, wait=True))
+            except Exception as e:
+                print("Error applying batch: %s") % e
+                # endpoints released for the batch are back
+                deploy()
+                sock.sendto(json.dumps({"error": str(e)}), address)
+                return
+
+        # counters don't change the configuration, reply with them only
+        elif request == 'stats':
+            interval = msg.get('interval')
+            if interval is not None:
+                interval = float(interval)
+            send_stats(address, interval)
+            return
+
+        # reply with the packet timings traced so far, 'every' turns tracing
+        # on for one batch in that many (0 for off)
+        elif request == 'trace':
+            if 'every' in msg:
+                latency.tracer.enable(int(msg['every']))
+            sock.sendto(json.dumps({"trace": latency.tracer.dump()}), address)
+            return
+
         elif request == 'save all':
             endpoint.save(msg['filename'])
-            
-        # Hard load replaces current configuration with load configuration
+
+        # Hard load replaces current configuration with load configuration,
+        # endpoints that are the same in both are left alone
         # Soft load appends load configuration to current configuration
         elif request == 'load all':
             if msg['soft'] == False:
                 print("Hard load")
-                # TODO: garbage collect?
-                endpoint.endpoints = []
-            endpoint.load(msg['filename'])
-            
+                configuration = endpoint.read(msg['filename'])
+                if configuration is not None:
+                    try:
+                        reload(configuration)
+                    except Exception as e:
+                        print("Error loading %s: %s") % (msg['filename'], e)
+                        sock.sendto(json.dumps({"error": str(e)}), address)
+                        return
+            else:
+                endpoint.load(msg['filename'])
+
+        # open, close and rewire endpoints for the new topology, and save it
+        if request in topology_requests:
+            if request != 'load all' or msg['soft'] != False:
+                deploy()
+            persister.save(endpoint.snapshot())
+
         # send updated list of endpoints
         sock.sendto(endpoint.to_json(), address)
-        
-        # save current list of endpoints
-        endpoint.save('/home/pi/routing.conf')
-        
+
     except socket.error as e:
-        continue
+        return
     except Exception as e:
         print("Error: %s") % e
-        continue
+        return
+
+
+# the control plane: requests are parsed, endpoints created, configurations
+# loaded and saved on this thread, forwarding never waits on any of it
+def control():
+    timeout = None
+    while True:
+        readable, writable, exceptional = select.select(
+            [sock] + ([watcher] if watcher is not None else []), [], [], timeout)
+        if sock in readable:
+            handle_request()
+        if watcher is not None and watcher in readable:
+            handle_change()
+        timeout = stream_stats()
+
+
+# edits to the configuration file apply right away
+watcher = None
+try:
+    watcher = inotify.Watcher()
+    watcher.add(os.path.dirname(CONFIGURATION), inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO)
+except Exception as e:
+    print("Not watching %s: %s") % (CONFIGURATION, e)
+    watcher = None
+
+
+_router = router.Router([])
+
+# endpoints with a 'shard' setting run in worker processes
+shards = shard.Shards(_router)
+deploy()
+
+thread = threading.Thread(target=control)
+thread.daemon = True
+thread.start()
+
+_router.run()
@@ -2,13 +2,261 @@
 
 import serial
 import socket
+import select
+import errno
+import fcntl
+import termios
+import array
+import collections
+import os
 import time
 import json
+import framing
+import shaper
+import shm
+import capture
+import filters
+import latency
+import persist
 
 debug = False
 
+# most datagrams to drain from one endpoint in a single pass, the router
+# comes back for the rest so one busy link can't starve the others
+MAX_BATCH = 64
+
+# largest udp datagram, nothing we receive is ever truncated
+MTU = 65507
+
+# largest datagram we send when packing frames together: ethernet frame
+# minus ip and udp headers
+DEFAULT_MTU = 1472
+
+# reads land in this buffer and targets are handed memoryview slices of it,
+# so there is no allocation or copy per datagram. The data is only valid
+# until the next read: a target that keeps it past write() must copy it
+buffer = bytearray(4 * MTU)
+view = memoryview(buffer)
+
+# endpoints in the order they were added
 endpoints = []
 
+# endpoint id -> endpoint
+index = {}
+
+# mavlink frames read recently by the endpoints that drop duplicates, so a
+# frame that comes in twice (over two links, or echoed back by a peer) is
+# only forwarded once
+duplicates = framing.Duplicates()
+
+# most routing loops reported when the topology changes
+MAX_LOOPS = 10
+
+# endpoints with outbound data held back (rate limits...), the router calls
+# flush() on them once their deadline() has passed
+pending = set()
+
+# endpoints with buffered output, the router calls write_ready() on them when
+# their file descriptor can take more
+backlogged = set()
+
+# endpoints that opened or closed file descriptors on their own (tcp clients
+# coming and going), the router re-syncs what it waits on
+changed = set()
+
+# bytes of output buffered per endpoint when the device can't keep up
+OUTPUT_BUFFER = 65536
+
+# what to do with output that doesn't fit in the buffer
+OVERFLOW_POLICIES = ['drop-oldest', 'drop-newest', 'block']
+
+# longest a 'block' overflow policy waits for room (seconds)
+BLOCK_TIMEOUT = 1.0
+
+# longest a coalescing udp endpoint holds output back waiting for more to
+# fill the datagram with (seconds)
+COALESCE_DELAY = 0.0005
+
+# udp server endpoints forget peers they haven't heard from in this long (seconds)
+PEER_TIMEOUT = 10.0
+
+# tcp client endpoints wait this long between connection attempts (seconds)
+RECONNECT_INTERVAL = 1.0
+
+# serial ports that are not present are tried again after this long, twice
+# as long after every failure up to SERIAL_BACKOFF_MAX (seconds). The router
+# wakes them up early when device nodes appear
+SERIAL_BACKOFF = 1.0
+SERIAL_BACKOFF_MAX = 8.0
+
+# most bytes taken from a serial port in one read
+SERIAL_READ = 4096
+
+# serial driver settings (linux/serial.h), for the low latency mode
+TIOCGSERIAL = getattr(termios, 'TIOCGSERIAL', 0x541E)
+TIOCSSERIAL = getattr(termios, 'TIOCSSERIAL', 0x541F)
+ASYNC_LOW_LATENCY = 1 << 13
+
+# not in python 2's socket module (linux value)
+IP_MULTICAST_ALL = getattr(socket, 'IP_MULTICAST_ALL', 49)
+
+# unix endpoint mode -> socket type
+UNIX_MODES = {
+	'dgram': socket.SOCK_DGRAM,
+	'seqpacket': socket.SOCK_SEQPACKET,
+}
+
+
+# bounded buffer in front of a non-blocking file descriptor, for what it
+# could not take yet. One slow consumer fills its own buffer and sheds data
+# according to the overflow policy instead of stalling the router
+class OutputBuffer(object):
+	
+	def __init__(self, limit=OUTPUT_BUFFER, overflow='drop-oldest'):
+		if overflow not in OVERFLOW_POLICIES:
+			raise ValueError("unknown overflow policy %s" % overflow)
+		self.limit = limit
+		self.overflow = overflow
+		self.data = bytearray()
+		# bytes dropped on overflow
+		self.dropped = 0
+		
+		
+	def __len__(self):
+		return len(self.data)
+		
+		
+	# write what the descriptor takes now, buffer the rest
+	def write(self, fd, data):
+		n = 0
+		# keep the order, nothing jumps ahead of buffered data
+		if not self.data:
+			n = self.send(fd, data)
+			if n == len(data):
+				return
+		
+		data = data[n:]
+		overflow = len(self.data) + len(data) - self.limit
+		if overflow > 0 and self.overflow == 'block':
+			self.wait(fd, overflow)
+			overflow = len(self.data) + len(data) - self.limit
+		
+		if overflow > 0:
+			if self.overflow == 'drop-oldest' and overflow < len(self.data):
+				del self.data[:overflow]
+				self.dropped += overflow
+			else:
+				self.dropped += len(data)
+				return
+		
+		self.data += data
+		
+		
+	# write as much of the buffered data as the descriptor takes
+	def flush(self, fd):
+		n = self.send(fd, self.data)
+		del self.data[:n]
+		
+		
+	# wait until the descriptor has taken at least this many buffered bytes
+	def wait(self, fd, size):
+		deadline = time.time() + BLOCK_TIMEOUT
+		while size > 0 and self.data:
+			timeout = deadline - time.time()
+			if timeout <= 0:
+				return
+			select.select([], [fd], [], timeout)
+			n = self.send(fd, self.data)
+			del self.data[:n]
+			size -= n
+			
+			
+	def send(self, fd, data):
+		try:
+			return os.write(fd, data)
+		except OSError as e:
+			if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+				return 0
+			raise
+
+# OutputBuffer for a socket that keeps message boundaries (unix seqpacket):
+# messages are queued, sent and dropped whole, never merged or cut
+class MessageBuffer(object):
+	
+	def __init__(self, limit=OUTPUT_BUFFER, overflow='drop-oldest'):
+		if overflow not in OVERFLOW_POLICIES:
+			raise ValueError("unknown overflow policy %s" % overflow)
+		self.limit = limit
+		self.overflow = overflow
+		self.messages = collections.deque()
+		self.size = 0
+		# bytes dropped on overflow
+		self.dropped = 0
+		
+		
+	def __len__(self):
+		return self.size
+		
+		
+	def write(self, fd, data):
+		# keep the order, nothing jumps ahead of queued messages
+		if not self.messages and self.send(fd, data):
+			return
+		
+		overflow = self.size + len(data) - self.limit
+		if overflow > 0 and self.overflow == 'block':
+			self.wait(fd, overflow)
+			overflow = self.size + len(data) - self.limit
+		
+		if overflow > 0:
+			if self.overflow == 'drop-oldest' and len(data) <= self.limit:
+				while self.size + len(data) > self.limit:
+					self.drop()
+			else:
+				self.dropped += len(data)
+				return
+		
+		# the data may be a view of a receive buffer
+		self.messages.append(bytearray(data))
+		self.size += len(data)
+		
+		
+	# send the queued messages the socket takes
+	def flush(self, fd):
+		while self.messages and self.send(fd, self.messages[0]):
+			self.size -= len(self.messages.popleft())
+			
+			
+	# wait until the socket has taken at least this many queued bytes
+	def wait(self, fd, size):
+		deadline = time.time() + BLOCK_TIMEOUT
+		while size > 0 and self.messages:
+			timeout = deadline - time.time()
+			if timeout <= 0:
+				return
+			select.select([], [fd], [], timeout)
+			before = self.size
+			self.flush(fd)
+			size -= before - self.size
+			
+			
+	def drop(self):
+		n = len(self.messages.popleft())
+		self.size -= n
+		self.dropped += n
+		
+		
+	# True if the whole message went out
+	def send(self, fd, data):
+		try:
+			os.write(fd, data)
+			return True
+		except OSError as e:
+			if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+				return False
+			raise
+
+
 class Endpoint(object):
 	
 	def __init__(self, id, type, connectionIds):
@@ -16,32 +264,420 @@ class Endpoint(object):
 		# unique
 		self.id = id
 		self.type = type
-		self.connectionIds = connectionIds
-		# target destinations for inbound traffic
-		self.connections = []
+		# configured target ids, the targets may not exist (yet), and the
+		# message filters of the connections that have one
+		self.connectionIds = []
+		self.connectionFilters = {}
+		# target destinations for inbound traffic and their filters, built
+		# from the configured connections by routes() whenever the topology
+		# changes and installed by the forwarding loop, see install()
+		self.connections = ()
+		self.filters = {}
+		# router process this endpoint runs in, 0 is the main process
+		self.shard = 0
+		# 'broadcast' forwards everything to every connection, 'mavlink'
+		# sends targeted mavlink messages only where their target lives
+		self.routing = 'broadcast'
+		# split inbound traffic into whole frames: 'raw', 'mavlink' or
+		# 'nmea-line', see framing.py
+		self.framing = 'raw'
+		self.framer = None
+		# drop mavlink frames already read by an endpoint with dedup on
+		self.dedup = False
+		# frames are packed into datagrams up to this size
+		self.mtu = DEFAULT_MTU
+		# mavlink systems and (system, component) seen behind this endpoint
+		self.systems = set()
+		self.components = set()
+		# outbound priority queues and rate limit, None to write immediately
+		self.shaper = None
+		
+		# traffic counters, see stats()
+		self.rx_packets = 0
+		self.rx_bytes = 0
+		self.tx_packets = 0
+		self.tx_bytes = 0
+		self.write_errors = 0
+		self.duplicates = 0
+		self.last_rx = 0
+		self.last_tx = 0
+		# target id -> [packets, bytes, latency histogram] forwarded along
+		# each route
+		self.routed = {}
+		
+		self.set_connections(connectionIds)
 		
 		
-	def connect(self, target):
-		if target.id == self.id:
+	# optional settings common to every endpoint type
+	def configure(self, options):
+		self.shard = int(options.get('shard', 0))
+		self.routing = options.get('routing', 'broadcast')
+		self.framing = options.get('framing', 'raw')
+		self.mtu = int(options.get('mtu', DEFAULT_MTU))
+		self.dedup = bool(options.get('dedup', False))
+		
+		self.framer = None
+		self.reframe()
+		
+		# outbound byte rate limit, with priorities by mavlink message id
+		self.shaper = None
+		if options.get('rate'):
+			self.shaper = shaper.Shaper(options['rate'],
+										options.get('burst'),
+										int(options.get('queue', shaper.QUEUE)),
+										options.get('priorities'))
+		
+		
+	# the optional settings that differ from the defaults, for to_json
+	def options(self):
+		options = {}
+		if self.shard:
+			options['shard'] = self.shard
+		if self.routing != 'broadcast':
+			options['routing'] = self.routing
+		if self.framing != 'raw':
+			options['framing'] = self.framing
+		if self.mtu != DEFAULT_MTU:
+			options['mtu'] = self.mtu
+		if self.dedup:
+			options['dedup'] = True
+		if self.shaper is not None:
+			options['rate'] = self.shaper.rate
+			options['burst'] = self.shaper.burst
+			options['queue'] = self.shaper.limit
+			priorities = dict((str(message), priority)
+							for message, priority in self.shaper.priorities.items()
+							if shaper.PRIORITIES.get(message, shaper.NORMAL) != priority)
+			if priorities:
+				options['priorities'] = priorities
+		return options
+		
+		
+	# mavlink routing, duplicate suppression, message filters and rate
+	# limited targets (which sort by message priority) need whole mavlink
+	# frames. The framer is only replaced when that changes, it may hold part
+	# of a frame
+	def reframe(self):
+		name = self.framing
+		if self.routing == 'mavlink' or self.dedup or self.filters:
+			name = 'mavlink'
+		# an explicit other framing is kept, its chunks are all NORMAL priority
+		if name == 'raw' and any(target.shaper is not None for target in self.connections):
+			name = 'mavlink'
+		if type(self.framer) is not type(framing.framer(name)):
+			self.framer = framing.framer(name)
+			
+			
+	# connections as in routing.conf: target ids, or {"id": ..., "allow":
+	# ...} for the ones with a message filter, see filters.py
+	# the routes don't change until the forwarding loop installs them
+	def set_connections(self, connections):
+		ids = []
+		compiled = {}
+		for entry in connections:
+			if isinstance(entry, dict):
+				target_id = entry['id']
+				settings = filters.settings(entry)
+				if settings is not None:
+					# an unchanged filter keeps its rate limit state
+					_filter = self.connectionFilters.get(target_id)
+					if _filter is None or _filter.settings != settings:
+						_filter = filters.Filter(settings)
+					compiled[target_id] = _filter
+			else:
+				target_id = entry
+			ids.append(target_id)
+		self.connectionIds = ids
+		self.connectionFilters = compiled
+		
+		
+	# switch to routes built by routes(), on the forwarding loop
+	def install(self, connections, filters):
+		self.connections = connections
+		self.filters = filters
+		self.reframe()
+		
+		
+	def connections_json(self):
+		connections = []
+		for target_id in self.connectionIds:
+			if target_id in self.connectionFilters:
+				entry = dict(self.connectionFilters[target_id].settings)
+				entry['id'] = target_id
+				connections.append(entry)
+			else:
+				connections.append(target_id)
+		return connections
+		
+		
+	# settings is the message filter of the connection, None for everything
+	def connect(self, target_id, settings=None):
+		if target_id == self.id:
 			print("loopback not allowed: %s") % self.id
 			return
-		if target.id in self.connectionIds:
-			print("%s is already connected to %s") % (self.id, target.id)
+		if target_id in self.connectionIds and settings is None:
+			print("%s is already connected to %s") % (self.id, target_id)
 			return
-		self.connections.append(target)
-		self.connectionIds.append(target.id)
+		connections = [entry for entry in self.connections_json() if entry != target_id
+					and not (isinstance(entry, dict) and entry['id'] == target_id)]
+		if settings is None:
+			connections.append(target_id)
+		else:
+			connections.append(dict(settings, id=target_id))
+		self.set_connections(connections)
 		
 		
 	def disconnect(self, target_id):
-		try:
-			self.connectionIds.remove(target_id)
-		except:
-			print("Error disconnecting %s") % target.id
+		if target_id not in self.connectionIds:
+			print("Error disconnecting %s") % target_id
+			return
+		self.set_connections([entry for entry in self.connections_json() if entry != target_id
+							and not (isinstance(entry, dict) and entry['id'] == target_id)])
+				
+				
+	# file descriptor to wait on for inbound traffic, None if there is
+	# nothing to wait on (ex. a serial port that is not open yet)
+	def fileno(self):
+		return None
+		
+		
+	# everything the router waits on for this endpoint: objects with
+	# fileno(), read() and write_ready(), usually just the endpoint itself
+	def pollables(self):
+		if self.fileno() is None:
+			return []
+		return [self]
+		
+		
+	def close(self):
+		self.socket.close()
+		
+		
+	# write a list of chunks read in one pass, through the outbound queues
+	# if the endpoint is rate limited
+	def write_batch(self, batch):
+		self.tx_packets += len(batch)
+		for data in batch:
+			self.tx_bytes += len(data)
+		self.last_tx = time.time()
+		
+		if self.shaper is None:
+			self.writev(batch)
+			return
+		
+		for data in batch:
+			self.shaper.put(data)
+		self.flush()
+		
+		
+	# write several chunks at once
+	def writev(self, batch):
+		for data in batch:
+			self.write(data)
+			
+			
+	# write what the rate limit allows
+	def flush(self):
+		now = time.time()
+		while True:
+			data = self.shaper.take(now, self.mtu)
+			if data is None:
+				break
+			self.write(data)
+		
+		if self.shaper.empty():
+			pending.discard(self)
+		else:
+			pending.add(self)
+			
+			
+	# the file descriptor can take more of the buffered output
+	def write_ready(self):
+		pass
+		
+		
+	# when flush() has something to write, None if nothing is held back
+	def deadline(self):
+		if self.shaper is None:
+			return None
+		return self.shaper.deadline()
+			
+			
+	# write data out on all outbound connections
+	def forward(self, batch):
+		self.rx_packets += len(batch)
+		for data in batch:
+			self.rx_bytes += len(data)
+		self.last_rx = start = time.time()
+		
+		if self.framer is None:
+			for endpoint in self.connections:
+				endpoint.write_batch(batch)
+				self.count(endpoint, batch, start)
+			return
+		
+		# only whole frames go out, packed together up to each target's mtu
+		frames = []
+		for data in batch:
+			frames += self.framer.feed(data)
+		
+		if self.dedup:
+			n = len(frames)
+			frames = duplicates.filter(frames, start)
+			self.duplicates += n - len(frames)
+		
+		if not frames:
+			return
+		
+		# ids are learned on every mavlink endpoint so targeted frames from
+		# elsewhere can reach a vehicle behind a plain one
+		if isinstance(self.framer, framing.MAVLinkParser):
+			self.learn(frames)
+		
+		if self.routing == 'mavlink':
+			self.route(frames, start)
 			return
 		
 		for endpoint in self.connections:
-			if endpoint.id == target_id:
-				self.connections.remove(endpoint)
+			selected = frames
+			if endpoint.id in self.filters:
+				selected = self.filters[endpoint.id].select(frames, start)
+				if not selected:
+					continue
+			chunks = framing.coalesce(selected, endpoint.mtu)
+			endpoint.write_batch(chunks)
+			self.count(endpoint, chunks, start)
+			
+			
+	# note who lives behind this endpoint from the mavlink frames it reads
+	def learn(self, frames):
+		for frame in frames:
+			system, component = framing.header(frame)[1:3]
+			self.systems.add(system)
+			self.components.add((system, component))
+			
+			
+	# mavlink routing: send targeted frames only to the connections their
+	# target was seen behind. Broadcasts, and frames for a target nobody
+	# has seen yet, go to every connection
+	def route(self, frames, start):
+		out = {}
+		for frame in frames:
+			target_system, target_component = framing.addresses(frame)[2:]
+			
+			targets = self.connections
+			if target_system != 0:
+				owners = [endpoint for endpoint in self.connections
+						if endpoint.owns(target_system, target_component)]
+				if owners:
+					targets = owners
+			
+			for endpoint in targets:
+				out.setdefault(endpoint, []).append(frame)
+		
+		for endpoint, frames in out.items():
+			if endpoint.id in self.filters:
+				frames = self.filters[endpoint.id].select(frames, start)
+				if not frames:
+					continue
+			chunks = framing.coalesce(frames, endpoint.mtu)
+			endpoint.write_batch(chunks)
+			self.count(endpoint, chunks, start)
+			
+			
+	# add a batch sent to a target to the route counters, start is when it
+	# was read
+	def count(self, target, batch, start):
+		elapsed = time.time() - start
+		route = self.routed.get(target.id)
+		if route is None:
+			route = self.routed[target.id] = [0, 0, latency.Histogram()]
+		route[0] += len(batch)
+		size = 0
+		for data in batch:
+			size += len(data)
+		route[1] += size
+		route[2].add(elapsed)
+		
+		if latency.tracer.every and latency.tracer.sample():
+			latency.tracer.record(start, self.id, target.id, len(batch), size, elapsed)
+			
+			
+	# bytes of output waiting to go out
+	def queued(self):
+		if self.shaper is None:
+			return 0
+		return self.shaper.depth()
+		
+		
+	# bytes of output dropped because the endpoint couldn't keep up
+	def dropped(self):
+		if self.shaper is None:
+			return 0
+		return self.shaper.drops
+		
+		
+	# counters for the 'stats' control request, kernel is the socket inode
+	# -> datagram drops table from kernel_drops()
+	def stats(self, kernel={}):
+		stats = {"id": self.id,
+				"type": self.type,
+				"rx_packets": self.rx_packets,
+				"rx_bytes": self.rx_bytes,
+				"tx_packets": self.tx_packets,
+				"tx_bytes": self.tx_bytes,
+				"dropped": self.dropped(),
+				"discarded": getattr(self, 'discarded', 0),
+				"coalesced": getattr(self, 'coalesced', 0),
+				"write_errors": self.write_errors,
+				"duplicates": self.duplicates,
+				"queued": self.queued(),
+				"last_rx": self.last_rx,
+				"last_tx": self.last_tx,
+				"routes": dict((target_id, {"packets": route[0],
+											"bytes": route[1],
+											"latency": route[2].summary()})
+							for target_id, route in self.routed.items())}
+		# frames the message filters dropped
+		for target_id, _filter in self.filters.items():
+			stats["routes"].setdefault(target_id, {})["filtered"] = _filter.dropped
+		if self.shard:
+			# the counters live in the worker process
+			stats["shard"] = self.shard
+		
+		# udp sockets only
+		fd = self.fileno()
+		if fd is not None:
+			inode = os.fstat(fd).st_ino
+			if inode in kernel:
+				stats["kernel_drops"] = kernel[inode]
+		return stats
+		
+		
+	# runs in a shard's worker process right after the fork, before it
+	# forwards anything. Threads of the main process don't exist there
+	def forked(self):
+		pass
+		
+		
+	# could this endpoint become the one configured by endpoint_json
+	# without being reopened: same type, address, port...
+	def same(self, endpoint_json):
+		configuration = self.to_json()
+		options = self.options()
+		for key, value in configuration.items():
+			if key in options or key == 'connections':
+				continue
+			if endpoint_json.get(key) != value:
+				return False
+		return True
+		
+		
+	# has this mavlink system (and component, 0 for any) been seen here
+	def owns(self, system, component):
+		if component == 0:
+			return system in self.systems
+		return (system, component) in self.components
 
 
 class SerialEndpoint(Endpoint):
@@ -55,20 +691,148 @@ class SerialEndpoint(Endpoint):
 		# not a socket! just a port
 		self.socket = serial.Serial()
 		self.socket.port = port
-		self.socket.baudrate = 115200
+		self.socket.baudrate = int(baudrate)
 		self.socket.timeout = 0
 		
+		self.output = OutputBuffer()
+		
+		# ask the driver to hand over every byte right away instead of
+		# batching (ASYNC_LOW_LATENCY, 1 ms latency timer on ftdi)
+		self.low_latency = False
+		# termios VMIN/VTIME: with vtime 0 the router isn't woken up until
+		# vmin bytes are in, None keeps the defaults
+		self.vmin = None
+		self.vtime = None
+		
+		# when to try opening the port next, and how long to wait after that
+		self.next_attempt = 0
+		self.backoff = SERIAL_BACKOFF
+		
+		
+	def configure(self, options):
+		Endpoint.configure(self, options)
+		self.output = OutputBuffer(int(options.get('buffer', OUTPUT_BUFFER)),
+								options.get('overflow', 'drop-oldest'))
+		low_latency = self.low_latency
+		self.low_latency = bool(options.get('low_latency', False))
+		self.vmin = options.get('vmin')
+		self.vtime = options.get('vtime')
+		# hardware flow control, applies when the port is (re)opened
+		self.socket.rtscts = bool(options.get('rtscts', False))
+		
+		# an open port takes the new settings now. Dropping vmin/vtime goes
+		# back to the defaults when the port is opened again
+		if self.socket.is_open:
+			self.tune(self.socket.fileno(), low_latency)
+		
+		
+	def options(self):
+		options = Endpoint.options(self)
+		if self.output.limit != OUTPUT_BUFFER:
+			options['buffer'] = self.output.limit
+		if self.output.overflow != 'drop-oldest':
+			options['overflow'] = self.output.overflow
+		if self.low_latency:
+			options['low_latency'] = True
+		if self.vmin is not None:
+			options['vmin'] = self.vmin
+		if self.vtime is not None:
+			options['vtime'] = self.vtime
+		if self.socket.rtscts:
+			options['rtscts'] = True
+		return options
+		
+		
+	# try to open the port, the router retries this periodically while
+	# the port is closed (device unplugged, rebooting...), backing off
+	def open(self):
+		if self.socket.is_open:
+			return True
+		
+		now = time.time()
+		if now < self.next_attempt:
+			return False
 		
-	def read(self):
 		try:
-			if not self.socket.is_open:
-				self.socket.open()
-				print('%s on %s:%s') % (self.id, self.port, self.baudrate)
-			data = self.socket.read(1024)
+			self.socket.open()
+			# writes go through our own buffer, never block on the port
+			fd = self.socket.fileno()
+			fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+			self.tune(fd)
+			print('%s on %s:%s') % (self.id, self.port, self.baudrate)
 			self.active = True
+			self.backoff = SERIAL_BACKOFF
 		except Exception as e:
+			self.close()
+			self.next_attempt = now + self.backoff
+			self.backoff = min(self.backoff * 2, SERIAL_BACKOFF_MAX)
+		return self.active
+		
+		
+	# termios and driver settings of the low latency mode, on the open port.
+	# The driver flag is only touched when it is wanted, or was (cleared)
+	def tune(self, fd, low_latency=False):
+		if self.vmin is not None or self.vtime is not None:
+			attributes = termios.tcgetattr(fd)
+			if self.vmin is not None:
+				attributes[6][termios.VMIN] = int(self.vmin)
+			if self.vtime is not None:
+				attributes[6][termios.VTIME] = int(self.vtime)
+			termios.tcsetattr(fd, termios.TCSANOW, attributes)
+		
+		if self.low_latency or low_latency:
+			try:
+				serial_struct = array.array('i', [0] * 32)
+				fcntl.ioctl(fd, TIOCGSERIAL, serial_struct)
+				# flags
+				if self.low_latency:
+					serial_struct[4] |= ASYNC_LOW_LATENCY
+				else:
+					serial_struct[4] &= ~ASYNC_LOW_LATENCY
+				fcntl.ioctl(fd, TIOCSSERIAL, serial_struct)
+			# not every driver has it (usb cdc acm doesn't need it)
+			except IOError as e:
+				print('%s: no low latency mode on %s: %s') % (self.id, self.port, e)
+		
+		
+	# a device node appeared, it may be ours: try again right away
+	def wake(self):
+		self.next_attempt = 0
+		self.backoff = SERIAL_BACKOFF
+		
+		
+	def close(self):
+		try:
 			self.socket.close()
-			self.active = False
+		except Exception as e:
+			pass
+		self.active = False
+		
+		# whatever was buffered is for a device that is gone
+		self.output.dropped += len(self.output)
+		del self.output.data[:]
+		backlogged.discard(self)
+		
+		
+	def fileno(self):
+		if self.socket.is_open:
+			return self.socket.fileno()
+		return None
+		
+		
+	def read(self):
+		try:
+			# everything the driver has buffered, in one system call
+			data = os.read(self.socket.fileno(), SERIAL_READ)
+			# readable but nothing there: hung up
+			if not data:
+				raise IOError(errno.EIO, 'hung up')
+		except Exception as e:
+			if getattr(e, 'errno', None) in (errno.EAGAIN, errno.EINTR):
+				return
+			# device went away, the router will try to open it again
+			print('%s lost %s') % (self.id, self.port)
+			self.close()
 			#print("Error reading serial endpoint: %s") % e
 			return
 		
@@ -78,30 +842,66 @@ class SerialEndpoint(Endpoint):
 				#print('%s read %s') % (self.id, data[:25].decode('utf-8'))
 				print('%s read') % self.id
 				
-			# write data out on all outbound connections
-			for endpoint in self.connections:
-				endpoint.write(data)
+			self.forward([data])
 	
 	
 	def write(self, data):
 		try:
 			if self.socket.is_open:
-				self.socket.write(data)
+				self.output.write(self.socket.fileno(), data)
 				if debug:
-					print('%s write %s') % (self.id, data[:25])
+					print('%s write %s') % (self.id, bytearray(data[:25]))
 				
-		# serial.SerialException
 		except Exception as e:
 			print("Error writing: %s") % e
+			self.write_errors += 1
 			return
 		
+		if len(self.output) > 0:
+			backlogged.add(self)
+			
+			
+	# the port can take more of the buffered output
+	def write_ready(self):
+		try:
+			self.output.flush(self.socket.fileno())
+		except Exception as e:
+			print("Error writing: %s") % e
+			self.write_errors += 1
+			self.close()
+			return
+		
+		if len(self.output) == 0:
+			backlogged.discard(self)
+			
+			
+	def queued(self):
+		return Endpoint.queued(self) + len(self.output)
+		
+		
+	def dropped(self):
+		return Endpoint.dropped(self) + self.output.dropped
+		
+		
+	# a byte stream has no boundaries to keep, one write for the whole batch
+	def writev(self, batch):
+		if len(batch) == 1:
+			self.write(batch[0])
+		else:
+			data = bytearray()
+			for chunk in batch:
+				data += chunk
+			self.write(data)
+		
 		
 	def to_json(self):
-		return {"id": self.id,
+		configuration = {"id": self.id,
 				"type": self.type,
 				"port": self.port,
 				"baudrate": self.baudrate,
-				"connections": self.connectionIds};
+				"connections": self.connections_json()};
+		configuration.update(self.options())
+		return configuration
 				
 		
 class UDPEndpoint(Endpoint):
@@ -116,28 +916,142 @@ class UDPEndpoint(Endpoint):
 		if (self.ip == '0.0.0.0'):
 			print('binding')
 			self.socket.bind((ip, int(port)))
+		self.setup()
+		
+		
+	# the state of every udp endpoint besides its socket, subclasses that
+	# open the socket their own way call this from their constructor
+	def setup(self):
+		# where we send to as a client
+		self.address = (self.ip, int(self.port))
+		# as a server: the address of every peer we heard from -> last time
+		# we heard from it, replies go to all of them
+		self.peers = {}
+		self.peer_timeout = PEER_TIMEOUT
+		self.last_expire = 0
+		# datagrams discarded because there was no peer to send them to
+		self.discarded = 0
+		self.coalesce = False
+		self.coalesce_delay = COALESCE_DELAY
+		# output held back, when it started and how many writes it holds
+		self.held = bytearray()
+		self.held_since = 0
+		self.held_chunks = 0
+		# datagrams saved by coalescing
+		self.coalesced = 0
+		
+		
+	def configure(self, options):
+		Endpoint.configure(self, options)
+		self.peer_timeout = float(options.get('peer_timeout', PEER_TIMEOUT))
+		# pack small writes (serial reads of a few frames) into datagrams
+		# up to the mtu, held back for at most coalesce_delay. Only for
+		# streams and whole frames, datagram boundaries are not kept
+		self.coalesce = bool(options.get('coalesce', False))
+		self.coalesce_delay = float(options.get('coalesce_delay', COALESCE_DELAY))
+		if not self.coalesce and self.held:
+			self.release()
+		
+		
+	def options(self):
+		options = Endpoint.options(self)
+		if self.peer_timeout != PEER_TIMEOUT:
+			options['peer_timeout'] = self.peer_timeout
+		if self.coalesce:
+			options['coalesce'] = True
+		if self.coalesce_delay != COALESCE_DELAY:
+			options['coalesce_delay'] = self.coalesce_delay
+		return options
+		
+		
+	def fileno(self):
+		return self.socket.fileno()
 		
 	def read(self):
-		try:
-			data, address = self.socket.recvfrom(1024)
-			self.destination = address
-		except:
-			return
+		# drain the socket, python has no recvmmsg so this is one recvfrom
+		# per datagram, but all of them are forwarded together
+		batch = []
+		offset = 0
+		now = time.time()
+		while len(batch) < MAX_BATCH and len(buffer) - offset >= MTU:
+			try:
+				n, address = self.socket.recvfrom_into(view[offset:], MTU)
+				self.peers[address] = now
+			except:
+				break
+			
+			if n > 0:
+				batch.append(view[offset:offset + n])
+				offset += n
 		
-		if len(data) > 0:
+		if len(batch) > 0:
 			if debug:
 				#print('%s read %s on %s') % (self.id, data[:25], address)
-				print("%s read") % self.id
+				print("%s read %d") % (self.id, len(batch))
 
-			for endpoint in self.connections:
-				endpoint.write(data)
+			self.forward(batch)
 				
 	def write(self, data):
+		if not self.coalesce:
+			self.send(data)
+			return
+		
+		if self.held and len(self.held) + len(data) > self.mtu:
+			self.release()
+		if not self.held:
+			if len(data) >= self.mtu:
+				self.send(data)
+				return
+			self.held_since = time.time()
+			self.held_chunks = 0
+			pending.add(self)
+		
+		self.held += data
+		self.held_chunks += 1
+		if len(self.held) >= self.mtu:
+			self.release()
+			
+			
+	# send what coalescing held back, as one datagram
+	def release(self):
+		data = self.held
+		self.held = bytearray()
+		self.coalesced += self.held_chunks - 1
+		self.send(data)
+		
+		
+	def flush(self):
+		if self.shaper is not None:
+			Endpoint.flush(self)
+		if self.held and time.time() >= self.held_since + self.coalesce_delay:
+			self.release()
+		
+		if self.held or (self.shaper is not None and not self.shaper.empty()):
+			pending.add(self)
+		else:
+			pending.discard(self)
+			
+			
+	def deadline(self):
+		deadline = Endpoint.deadline(self)
+		if self.held:
+			due = self.held_since + self.coalesce_delay
+			if deadline is None or due < deadline:
+				deadline = due
+		return deadline
+		
+		
+	def send(self, data):
 		try:
 			if (self.ip == '0.0.0.0'):
-				self.socket.sendto(data, self.destination)
+				self.expire()
+				if not self.peers:
+					self.discarded += 1
+					return
+				for peer in self.peers:
+					self.socket.sendto(data, peer)
 			else:
-				self.socket.sendto(data, (self.ip, int(self.port)))
+				self.socket.sendto(data, self.address)
 			
 			if debug:
 				#print('%s write %s') % (self.id, data[:25])
@@ -145,65 +1059,724 @@ class UDPEndpoint(Endpoint):
 
 		except Exception as e:
 			print e
+			self.write_errors += 1
 			return
+			
+			
+	# forget the peers that have gone quiet, at most once a second
+	def expire(self):
+		now = time.time()
+		if now - self.last_expire < 1.0:
+			return
+		self.last_expire = now
+		
+		for peer, last_seen in self.peers.items():
+			if now - last_seen > self.peer_timeout:
+				print('%s forgetting %s:%s') % ((self.id,) + peer)
+				del self.peers[peer]
 
 
 	def to_json(self):
-		return {"id": self.id,
+		configuration = {"id": self.id,
 				"type": self.type,
 				"port": self.port,
 				"ip": self.ip,
-				"connections": self.connectionIds};
+				"connections": self.connections_json()};
+		configuration.update(self.options())
+		return configuration
 
 
-def add(new_endpoint):
-	for existing_endpoint in endpoints:
-		if new_endpoint.id == existing_endpoint.id:
-			print("Error adding endpoint %s, id already exists") % new_endpoint.id
+# udp to a multicast group, one send reaches every subscribed topside
+# station however many there are. Replies come back unicast to the port we
+# send from, so we only bind the port and don't join the group ourselves
+class MulticastEndpoint(UDPEndpoint):
+	
+	def __init__(self, group, port, id, connections):
+		Endpoint.__init__(self, id, 'multicast', connections)
+		self.ip = group
+		self.port = port
+		if not 224 <= int(group.split('.')[0]) <= 239:
+			raise ValueError("%s is not a multicast group" % group)
+		
+		self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		# linux hands a socket bound to a port the group traffic to that port
+		# even if it didn't join, that would be our own datagrams coming back
+		self.socket.setsockopt(socket.IPPROTO_IP, IP_MULTICAST_ALL, 0)
+		self.socket.setblocking(False)
+		print('%s on multicast %s:%s') % (self.id, self.ip, self.port)
+		self.socket.bind(('0.0.0.0', int(port)))
+		
+		self.setup()
+		# hops the datagrams may take, 1 stays on the local network
+		self.ttl = 1
+		# whether listeners on this machine get a copy
+		self.loopback = False
+		# address of the interface to send from, 0.0.0.0 for the default route
+		self.interface = '0.0.0.0'
+		
+		
+	def configure(self, options):
+		UDPEndpoint.configure(self, options)
+		self.ttl = int(options.get('ttl', 1))
+		self.loopback = bool(options.get('loopback', False))
+		self.interface = options.get('interface', '0.0.0.0')
+		
+		self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.ttl)
+		self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, int(self.loopback))
+		self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.interface))
+		
+		
+	def options(self):
+		options = UDPEndpoint.options(self)
+		if self.ttl != 1:
+			options['ttl'] = self.ttl
+		if self.loopback:
+			options['loopback'] = True
+		if self.interface != '0.0.0.0':
+			options['interface'] = self.interface
+		return options
+
+
+# printable peer address, (ip, port) or a unix socket path
+def describe(address):
+	if isinstance(address, tuple):
+		return '%s:%s' % address[:2]
+	return address or 'unnamed'
+
+
+# one connection of a tcp endpoint, the router polls it on its own
+class TCPConnection(object):
+	
+	def __init__(self, endpoint, sock, address, connecting=False):
+		self.endpoint = endpoint
+		self.socket = sock
+		self.address = address
+		# a client connect() that has not completed yet
+		self.connecting = connecting
+		self.output = endpoint.output_buffer()
+		
+		self.socket.setblocking(False)
+		if self.socket.family == socket.AF_INET:
+			self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(endpoint.nodelay))
+		
+		# we learn that the connection is up when it becomes writable
+		if connecting:
+			backlogged.add(self)
+			
+			
+	def fileno(self):
+		if self.socket is None:
+			return None
+		return self.socket.fileno()
+		
+		
+	def read(self):
+		if self.socket is not None:
+			self.endpoint.receive(self)
+		
+		
+	def write(self, data):
+		if self.connecting:
 			return
-	for existing_endpoint in endpoints:
-		if new_endpoint.id in existing_endpoint.connectionIds:
-			existing_endpoint.connections.append(new_endpoint)
-		if existing_endpoint.id in new_endpoint.connectionIds:
-			new_endpoint.connections.append(existing_endpoint)
+		
+		try:
+			self.output.write(self.socket.fileno(), data)
+		except Exception as e:
+			print("%s error writing to %s: %s") % (self.endpoint.id, describe(self.address), e)
+			self.endpoint.write_errors += 1
+			self.close()
+			return
+		
+		if len(self.output) > 0:
+			backlogged.add(self)
+			
 			
+	def write_ready(self):
+		if self.connecting:
+			error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+			if error:
+				self.close()
+				return
+			self.connecting = False
+			print('%s connected to %s') % (self.endpoint.id, describe(self.address))
+		
+		try:
+			self.output.flush(self.socket.fileno())
+		except Exception as e:
+			self.endpoint.write_errors += 1
+			self.close()
+			return
+		
+		if len(self.output) == 0:
+			backlogged.discard(self)
+			
+			
+	def close(self):
+		if self.socket is None:
+			return
+		self.socket.close()
+		self.socket = None
+		backlogged.discard(self)
+		self.endpoint.closed(self)
+
+
+# tcp endpoint, like udp a 0.0.0.0 address listens for any number of clients
+# and anything else is a client that connects out and keeps reconnecting.
+# Every connection has its own output buffer, so one slow peer sheds its
+# own data instead of stalling the others
+class TCPEndpoint(Endpoint):
+	
+	def __init__(self, ip, port, id, connections):
+		Endpoint.__init__(self, id, 'tcp', connections)
+		self.ip = ip
+		self.port = port
+		self.address = (self.ip, int(self.port))
+		# disable nagle, we forward small frames that should go out now
+		self.nodelay = True
+		self.buffer = OUTPUT_BUFFER
+		self.overflow = 'drop-oldest'
+		self.clients = []
+		self.next_attempt = 0
+		# writes discarded because nobody was connected
+		self.discarded = 0
+		# output dropped by connections that are gone
+		self.lost = 0
+		
+		print('%s on tcp %s:%s') % (self.id, self.ip, self.port)
+		self.listener = None
+		if (self.ip == '0.0.0.0'):
+			print('listening')
+			self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+			self.listener.setblocking(False)
+			self.listener.bind(self.address)
+			self.listener.listen(8)
+			
+			
+	def configure(self, options):
+		Endpoint.configure(self, options)
+		self.nodelay = bool(options.get('nodelay', True))
+		self.buffer = int(options.get('buffer', OUTPUT_BUFFER))
+		self.overflow = options.get('overflow', 'drop-oldest')
+		if self.overflow not in OVERFLOW_POLICIES:
+			raise ValueError("unknown overflow policy %s" % self.overflow)
+		
+		
+	def options(self):
+		options = Endpoint.options(self)
+		if not self.nodelay:
+			options['nodelay'] = False
+		if self.buffer != OUTPUT_BUFFER:
+			options['buffer'] = self.buffer
+		if self.overflow != 'drop-oldest':
+			options['overflow'] = self.overflow
+		return options
+		
+		
+	# for a new connection
+	def output_buffer(self):
+		return OutputBuffer(self.buffer, self.overflow)
+		
+		
+	def fileno(self):
+		if self.listener is None:
+			return None
+		return self.listener.fileno()
+		
+		
+	def pollables(self):
+		return Endpoint.pollables(self) + self.clients
+		
+		
+	# client: start connecting, the router calls this until it returns True
+	def open(self):
+		if self.listener is not None or self.clients:
+			return True
+		if time.time() < self.next_attempt:
+			return False
+		self.next_attempt = time.time() + RECONNECT_INTERVAL
+		
+		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		sock.setblocking(False)
+		error = sock.connect_ex(self.address)
+		if error not in (0, errno.EINPROGRESS):
+			sock.close()
+			return False
+		
+		self.clients.append(TCPConnection(self, sock, self.address, connecting=(error != 0)))
+		return True
+		
+		
+	# server: a client is connecting
+	def read(self):
+		try:
+			sock, address = self.listener.accept()
+		except socket.error as e:
+			return
+		
+		print('%s accepted %s') % (self.id, describe(address))
+		self.clients.append(TCPConnection(self, sock, address))
+		changed.add(self)
+		
+		
+	# inbound data on one of the connections
+	def receive(self, connection):
+		batch = []
+		offset = 0
+		while len(batch) < MAX_BATCH and len(buffer) - offset >= MTU:
+			try:
+				n = connection.socket.recv_into(view[offset:], MTU)
+			except socket.error as e:
+				if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+					break
+				n = 0
+			
+			# the peer hung up
+			if n == 0:
+				connection.close()
+				break
+			
+			batch.append(view[offset:offset + n])
+			offset += n
+		
+		if len(batch) > 0:
+			if debug:
+				print("%s read %d") % (self.id, len(batch))
+			
+			self.forward(batch)
+			
+			
+	def write(self, data):
+		if not self.clients:
+			self.discarded += 1
+			return
+		
+		for connection in list(self.clients):
+			connection.write(data)
+		
+		if debug:
+			print("%s write") % self.id
+			
+			
+	# a connection went away
+	def closed(self, connection):
+		print('%s lost %s') % (self.id, describe(connection.address))
+		self.lost += connection.output.dropped + len(connection.output)
+		if connection in self.clients:
+			self.clients.remove(connection)
+		changed.add(self)
+		
+		
+	def queued(self):
+		return Endpoint.queued(self) + sum(len(connection.output) for connection in self.clients)
+		
+		
+	def dropped(self):
+		return (Endpoint.dropped(self) + self.lost +
+				sum(connection.output.dropped for connection in self.clients))
+		
+		
+	def close(self):
+		for connection in list(self.clients):
+			connection.close()
+		if self.listener is not None:
+			self.listener.close()
+			
+			
+	def to_json(self):
+		configuration = {"id": self.id,
+				"type": self.type,
+				"port": self.port,
+				"ip": self.ip,
+				"connections": self.connections_json()};
+		configuration.update(self.options())
+		return configuration
+
+
+# unix domain socket for local consumers, the router binds the path. In
+# 'dgram' mode replies go to every peer that sent from a bound address,
+# like a udp server. 'seqpacket' accepts connections like a tcp server but
+# keeps message boundaries
+class UnixEndpoint(TCPEndpoint):
+	
+	def __init__(self, path, mode, id, connections):
+		Endpoint.__init__(self, id, 'unix', connections)
+		if mode not in UNIX_MODES:
+			raise ValueError("unknown unix socket mode %s" % mode)
+		self.path = path
+		self.mode = mode
+		self.nodelay = True
+		self.buffer = OUTPUT_BUFFER
+		self.overflow = 'drop-oldest'
+		# seqpacket connections
+		self.clients = []
+		# dgram peers
+		self.peers = set()
+		self.discarded = 0
+		self.lost = 0
+		
+		# a socket left behind by a previous run
+		try:
+			os.unlink(path)
+		except OSError as e:
+			pass
+		
+		print('%s on unix %s %s') % (self.id, self.mode, self.path)
+		self.listener = socket.socket(socket.AF_UNIX, UNIX_MODES[mode])
+		self.listener.setblocking(False)
+		self.listener.bind(path)
+		if mode == 'seqpacket':
+			self.listener.listen(8)
+			
+			
+	def read(self):
+		if self.mode == 'seqpacket':
+			TCPEndpoint.read(self)
+			return
+		
+		batch = []
+		offset = 0
+		while len(batch) < MAX_BATCH and len(buffer) - offset >= MTU:
+			try:
+				n, address = self.listener.recvfrom_into(view[offset:], MTU)
+			except socket.error as e:
+				break
+			
+			# an unbound sender can't be replied to
+			if address:
+				self.peers.add(address)
+			
+			if n > 0:
+				batch.append(view[offset:offset + n])
+				offset += n
+		
+		if len(batch) > 0:
+			if debug:
+				print("%s read %d") % (self.id, len(batch))
+			
+			self.forward(batch)
+			
+			
+	# seqpacket connections keep message boundaries
+	def output_buffer(self):
+		if self.mode == 'seqpacket':
+			return MessageBuffer(self.buffer, self.overflow)
+		return TCPEndpoint.output_buffer(self)
+		
+		
+	def write(self, data):
+		if self.mode == 'seqpacket':
+			TCPEndpoint.write(self, data)
+			return
+		
+		if not self.peers:
+			self.discarded += 1
+			return
+		
+		for peer in list(self.peers):
+			try:
+				self.listener.sendto(data, peer)
+			except socket.error as e:
+				# the peer closed its socket
+				if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+					print('%s forgetting %s') % (self.id, peer)
+					self.peers.discard(peer)
+				else:
+					self.write_errors += 1
+		
+		if debug:
+			print("%s write") % self.id
+			
+			
+	def close(self):
+		TCPEndpoint.close(self)
+		try:
+			os.unlink(self.path)
+		except OSError as e:
+			pass
+			
+			
+	def to_json(self):
+		configuration = {"id": self.id,
+				"type": self.type,
+				"path": self.path,
+				"mode": self.mode,
+				"connections": self.connections_json()};
+		configuration.update(self.options())
+		return configuration
+
+
+# publishes everything routed to it in a shared memory ring (a file in
+# /dev/shm) that local consumers attach to with shm.Subscriber, without a
+# system call per chunk. Output only, consumers can't write back
+class ShmEndpoint(Endpoint):
+	
+	def __init__(self, path, id, connections):
+		Endpoint.__init__(self, id, 'shm', connections)
+		self.path = path
+		self.size = shm.RING_SIZE
+		self.ring = None
+		
+		
+	def configure(self, options):
+		# room for more than the largest chunk, readers fall behind by that
+		# much. Checked before anything changes, the ring stays as it was
+		size = int(options.get('size', shm.RING_SIZE))
+		smallest = shm.MAX_CHUNK + shm.RECORD.size + 1
+		if size < smallest:
+			raise ValueError("shm size of %s must be at least %d" % (self.id, smallest))
+		Endpoint.configure(self, options)
+		self.size = size
+		if self.ring is not None:
+			self.ring.close()
+		print('%s on shm %s') % (self.id, self.path)
+		self.ring = shm.Publisher(self.path, self.size)
+		
+		
+	def options(self):
+		options = Endpoint.options(self)
+		if self.size != shm.RING_SIZE:
+			options['size'] = self.size
+		return options
+		
+		
+	def write(self, data):
+		if self.ring is not None:
+			self.ring.publish(data)
+			
+			
+	def close(self):
+		if self.ring is not None:
+			self.ring.close()
+			self.ring = None
+		try:
+			os.unlink(self.path)
+		except OSError as e:
+			pass
+			
+			
+	def to_json(self):
+		configuration = {"id": self.id,
+				"type": self.type,
+				"path": self.path,
+				"connections": self.connections_json()};
+		configuration.update(self.options())
+		return configuration
+
+
+# records everything routed to it, with the time, in capture files that
+# capture-replay.py plays back. Output only
+class CaptureEndpoint(Endpoint):
+	
+	def __init__(self, path, id, connections):
+		Endpoint.__init__(self, id, 'capture', connections)
+		# segment files are named path-000001.cap...
+		self.path = path
+		self.segment = capture.SEGMENT_SIZE
+		self.keep = 0
+		self.compress = False
+		self.writer = None
+		
+		
+	def configure(self, options):
+		Endpoint.configure(self, options)
+		self.segment = int(options.get('segment', capture.SEGMENT_SIZE))
+		self.keep = int(options.get('keep', 0))
+		self.compress = bool(options.get('compress', False))
+		if self.writer is not None:
+			# the writer thread picks these up with its next block, this
+			# runs on the forwarding loop and must not wait for the disk
+			self.writer.segment = self.segment
+			self.writer.keep = self.keep
+			self.writer.compress = self.compress
+			return
+		print('%s capturing to %s') % (self.id, self.path)
+		self.writer = capture.Writer(self.path, self.segment, self.keep, self.compress)
+		
+		
+	def options(self):
+		options = Endpoint.options(self)
+		if self.segment != capture.SEGMENT_SIZE:
+			options['segment'] = self.segment
+		if self.keep:
+			options['keep'] = self.keep
+		if self.compress:
+			options['compress'] = True
+		return options
+		
+		
+	def write(self, data):
+		if self.writer is not None:
+			self.writer.write(data, time.time())
+			
+			
+	# the whole batch gets the same time
+	def writev(self, batch):
+		if self.writer is None:
+			return
+		now = time.time()
+		for data in batch:
+			self.writer.write(data, now)
+			
+			
+	def queued(self):
+		if self.writer is None:
+			return Endpoint.queued(self)
+		return Endpoint.queued(self) + self.writer.queued
+		
+		
+	def dropped(self):
+		if self.writer is None:
+			return Endpoint.dropped(self)
+		return Endpoint.dropped(self) + self.writer.drops
+		
+		
+	# the writer thread stayed behind in the main process, this shard
+	# writes with its own
+	def forked(self):
+		if self.writer is not None:
+			self.writer = capture.Writer(self.path, self.segment, self.keep, self.compress)
+			
+			
+	# the writer finishes the capture on its own thread
+	def close(self):
+		if self.writer is not None:
+			self.writer.stop()
+			self.writer = None
+			
+			
+	def to_json(self):
+		configuration = {"id": self.id,
+				"type": self.type,
+				"path": self.path,
+				"connections": self.connections_json()};
+		configuration.update(self.options())
+		return configuration
+
+
+# socket inode -> datagrams the kernel dropped because the socket's receive
+# buffer was full, for every udp socket on the machine
+def kernel_drops():
+	drops = {}
+	for filename in ('/proc/net/udp', '/proc/net/udp6'):
+		try:
+			f = open(filename, 'r')
+			lines = f.readlines()[1:]
+			f.close()
+		except IOError as e:
+			continue
+		
+		for line in lines:
+			fields = line.split()
+			drops[int(fields[9])] = int(fields[-1])
+	return drops
+
+
+# counters of every endpoint, for the 'stats' control request
+def stats():
+	kernel = kernel_drops()
+	return [endpoint.stats(kernel) for endpoint in endpoints]
+
+
+# endpoint -> (fan-out tuple, target id -> filter) for a list of endpoints,
+# built from their configured connections without touching the live routes
+def routes(endpoints):
+	ids = dict((endpoint.id, endpoint) for endpoint in endpoints)
+	routes = {}
+	for endpoint in endpoints:
+		targets = tuple(ids[target_id] for target_id in endpoint.connectionIds
+						if target_id in ids)
+		routes[endpoint] = (targets, dict((target.id, endpoint.connectionFilters[target.id])
+										for target in targets
+										if target.id in endpoint.connectionFilters))
+	return routes
+
+
+# cycles of three or more endpoints in the routes, as lists of ids. A
+# frame can go round one of them for as long as the peers on the way echo
+# it back (udp broadcast, mirrored ground stations). Two endpoints routed to
+# each other are not a loop, that is an ordinary two way link
+def loops(routes, limit=MAX_LOOPS):
+	order = sorted(routes, key=lambda endpoint: endpoint.id)
+	rank = dict((endpoint, i) for i, endpoint in enumerate(order))
+	found = []
+	
+	# each cycle is found once, from its first endpoint in order
+	def visit(first, path, on_path):
+		for target in routes[path[-1]][0]:
+			if len(found) >= limit:
+				return
+			if target is first:
+				if len(path) >= 3:
+					found.append([endpoint.id for endpoint in path] + [first.id])
+			elif rank.get(target, -1) > rank[first] and target not in on_path:
+				path.append(target)
+				on_path.add(target)
+				visit(first, path, on_path)
+				on_path.discard(target)
+				path.pop()
+	
+	for first in order:
+		visit(first, [first], set([first]))
+	return found
+
+
+def get(endpoint_id):
+	return index.get(endpoint_id)
+
+
+def add(new_endpoint):
+	if new_endpoint.id in index:
+		print("Error adding endpoint %s, id already exists") % new_endpoint.id
+		return
+	
 	endpoints.append(new_endpoint)
+	index[new_endpoint.id] = new_endpoint
 
 
 def remove(endpoint_id):
-	remove = None
-	for endpoint in endpoints:
-		if endpoint.id == endpoint_id:
-			remove = endpoint
-			break
-		
+	remove = index.pop(endpoint_id, None)
+	
 	if remove is None:
 		print("Error removing endpoint %s, id doesn't exist") % endpoint_id
 		return
 	
 	print("remove: %s") % remove
-	try:
-		remove.socket.close()
-		endpoints.remove(remove)
-		print("removed endpoint %s") % remove.id
-		
-		
-		for endpoint in endpoints:
-			endpoint.connections.remove(remove)
-			endpoint.connections.connectionIds.remove(remove.id)
-				
-				
-	except Exception as e:
-		#print("Error removing: %s") % e
-		pass
+	endpoints.remove(remove)
+	
+	for endpoint in endpoints:
+		if remove.id in endpoint.connectionIds:
+			endpoint.disconnect(remove.id)
+	
+	# closed by the forwarding loop once nothing routes to it, see
+	# shard.Shards.start()
+	print("removed endpoint %s") % remove.id
 
 
-def to_json(endpoint_id=None):
+# forget every endpoint
+def clear():
+	del endpoints[:]
+	index.clear()
+
+
+# the configuration of every endpoint, as plain data that doesn't change
+# with the endpoints
+def snapshot():
 	configuration = []
 	for endpoint in endpoints:
-		configuration.append(endpoint.to_json())
-	configuration = {"endpoints": configuration}
-	return json.dumps(configuration, indent=4)
+		endpoint_json = endpoint.to_json()
+		endpoint_json['connections'] = list(endpoint_json['connections'])
+		configuration.append(endpoint_json)
+	return {"endpoints": configuration}
+
+
+def to_json(endpoint_id=None):
+	return json.dumps(snapshot(), indent=4)
+
+# endpoint types from_json() creates
+TYPES = ('serial', 'udp', 'multicast', 'tcp', 'unix', 'shm', 'capture')
+
 
 def from_json(endpoint_json):
 	if endpoint_json['type'] == 'serial':
@@ -219,37 +1792,170 @@ def from_json(endpoint_json):
 							endpoint_json['port'],
 							endpoint_json['id'],
 							endpoint_json['connections'])
+		
+	elif endpoint_json['type'] == 'multicast':
+		new_endpoint = MulticastEndpoint(
+							endpoint_json['ip'],
+							endpoint_json['port'],
+							endpoint_json['id'],
+							endpoint_json['connections'])
+		
+	elif endpoint_json['type'] == 'tcp':
+		new_endpoint = TCPEndpoint(
+							endpoint_json['ip'],
+							endpoint_json['port'],
+							endpoint_json['id'],
+							endpoint_json['connections'])
+		
+	elif endpoint_json['type'] == 'unix':
+		new_endpoint = UnixEndpoint(
+							endpoint_json['path'],
+							endpoint_json.get('mode', 'dgram'),
+							endpoint_json['id'],
+							endpoint_json['connections'])
+		
+	elif endpoint_json['type'] == 'shm':
+		new_endpoint = ShmEndpoint(
+							endpoint_json['path'],
+							endpoint_json['id'],
+							endpoint_json['connections'])
+		
+	elif endpoint_json['type'] == 'capture':
+		new_endpoint = CaptureEndpoint(
+							endpoint_json['path'],
+							endpoint_json['id'],
+							endpoint_json['connections'])
+		
+	else:
+		raise ValueError("unknown endpoint type %s" % endpoint_json['type'])
 	
+	new_endpoint.configure(endpoint_json)
 	return new_endpoint
 
 
-def connect(source_id, target_id):
-	source = None
-	target = None
-	for endpoint in endpoints:
-		if endpoint.id == source_id:
-			source = endpoint
-		if endpoint.id == target_id:
-			target = endpoint
+# apply a list of add/remove/connect/disconnect requests all together or not
+# at all. Everything is checked before anything changes, an exception leaves
+# the endpoints as they were. Endpoints the batch removes may hold the port
+# of one it adds: release(ids) is called to close them before the new ones
+# are created, and they are opened again if that fails
+def apply(operations, release=None):
+	ids = set(index)
+	removed = []
+	adding = False
+	try:
+		for operation in operations:
+			request = operation.get('request')
+			if request == 'add endpoint':
+				for key in ('id', 'type', 'connections'):
+					if key not in operation:
+						raise ValueError("endpoint entry without %s" % key)
+				if operation['id'] in ids:
+					raise ValueError("endpoint %s already exists" % operation['id'])
+				check_connections(operation['connections'])
+				ids.add(operation['id'])
+				adding = True
+			
+			elif request == 'remove endpoint':
+				if operation['id'] not in ids:
+					raise ValueError("endpoint %s doesn't exist" % operation['id'])
+				ids.discard(operation['id'])
+				if operation['id'] in index:
+					removed.append(operation['id'])
+			
+			elif request == 'connect endpoints':
+				for endpoint_id in (operation['source'], operation['target']):
+					if endpoint_id not in ids:
+						raise ValueError("endpoint %s doesn't exist" % endpoint_id)
+				check_connections([dict(operation, id=operation['target'])])
+			
+			elif request == 'disconnect endpoints':
+				if operation['source'] not in ids:
+					raise ValueError("endpoint %s doesn't exist" % operation['source'])
+			
+			else:
+				raise ValueError("%s can't be batched" % request)
+	
+	except KeyError as error:
+		raise ValueError("missing %s" % error)
+	
+	released = []
+	if removed and adding and release is not None:
+		released = [index[endpoint_id] for endpoint_id in removed]
+		release(removed)
+	
+	try:
+		created = build([operation for operation in operations
+						 if operation['request'] == 'add endpoint'])
+	except Exception as error:
+		for endpoint in released:
+			restore(endpoint)
+		raise
+	
+	created = iter(created)
+	for operation in operations:
+		request = operation['request']
+		if request == 'add endpoint':
+			add(next(created))
+		elif request == 'remove endpoint':
+			remove(operation['id'])
+		elif request == 'connect endpoints':
+			connect(operation['source'], operation['target'], filters.settings(operation))
+		elif request == 'disconnect endpoints':
+			disconnect(operation['source'], operation['target'])
+
+
+# create endpoints from a list of entries, all of them or none: the ones
+# created are closed again if one fails
+def build(entries):
+	created = []
+	try:
+		for endpoint_json in entries:
+			created.append(from_json(endpoint_json))
+	except Exception as error:
+		for endpoint in created:
+			try:
+				endpoint.close()
+			except Exception as e:
+				pass
+		if isinstance(error, KeyError):
+			raise ValueError("missing %s" % error)
+		raise
+	return created
+
+
+# open a released endpoint again, in its place
+def restore(old):
+	try:
+		new_endpoint = from_json(old.to_json())
+	except Exception as e:
+		print("Error restoring %s: %s") % (old.id, e)
+		remove(old.id)
+		return
+	endpoints[endpoints.index(old)] = new_endpoint
+	index[old.id] = new_endpoint
+
+
+def connect(source_id, target_id, settings=None):
+	source = index.get(source_id)
+	target = index.get(target_id)
 			
 	if source is None:
 		print("Error: source %s is not present") % source_id
+		return
 		
 	if target is None:
 		print("Error: target %s is not present") % target_id
+		return
 		
-	source.connect(target)
+	source.connect(target_id, settings)
 
 
 def disconnect(source_id, target_id):
-	source = None
-
-	for endpoint in endpoints:
-		if endpoint.id == source_id:
-			source = endpoint
+	source = index.get(source_id)
 			
 	if source is None:
 		print("Error: source %s is not present") % source_id
+		return
 		
 	#it's ok if target does not exist, it may still be a desired endpoint
 		
@@ -261,38 +1967,94 @@ def get_endpoints():
 
 
 def save(filename):
-	f = open(filename, 'w+')
-	f.write(to_json())
-	f.close()
+	persist.write(filename, snapshot())
 
 
-def load(filename):
+# the configuration in a file, None if it can't be read
+def read(filename):
 	try:
 		f = open(filename, 'r')
 		configuration = json.load(f)
 		f.close()
 	except Exception as e:
 		print("Error loading from file %s: %s") % (filename, e)
+		return None
+	return configuration
+
+
+def load(filename):
+	configuration = read(filename)
+	if configuration is None:
 		return
 	
 	for endpoint in configuration['endpoints']:
 		try:
-			if endpoint['type'] == 'serial':
-				new_endpoint = SerialEndpoint(
-									endpoint['port'],
-									endpoint['baudrate'],
-									endpoint['id'],
-									endpoint['connections'])
-				
-			elif endpoint['type'] == 'udp':
-				new_endpoint = UDPEndpoint(
-									endpoint['ip'],
-									endpoint['port'],
-									endpoint['id'],
-									endpoint['connections'])
-			
-			add(new_endpoint)
+			add(from_json(endpoint))
 		
 		except Exception as e:
 			print(e)
 			pass
+
+
+# raise ValueError unless every entry of a configuration has an id, a type
+# and connections, ids are unique and the connection filters are valid.
+# Nothing is created, this is checked before anything changes
+def check(configuration):
+	if not isinstance(configuration.get('endpoints'), list):
+		raise ValueError("no endpoint list")
+	ids = set()
+	for endpoint_json in configuration['endpoints']:
+		for key in ('id', 'type', 'connections'):
+			if key not in endpoint_json:
+				raise ValueError("endpoint entry without %s: %s" % (key, endpoint_json))
+		if endpoint_json['id'] in ids:
+			raise ValueError("endpoint %s is there twice" % endpoint_json['id'])
+		if endpoint_json['type'] not in TYPES:
+			raise ValueError("unknown endpoint type %s" % endpoint_json['type'])
+		ids.add(endpoint_json['id'])
+		check_connections(endpoint_json['connections'])
+
+
+# raise ValueError if a connection list can't be set, see set_connections()
+def check_connections(connections):
+	for entry in connections:
+		if isinstance(entry, dict):
+			if 'id' not in entry:
+				raise ValueError("connection without id: %s" % entry)
+			settings = filters.settings(entry)
+			if settings is not None:
+				filters.Filter(settings)
+
+
+# compare a configuration with the running endpoints. Returns the ids of the
+# endpoints to remove, the entries to create endpoints from, and (endpoint,
+# entry) for the endpoints that are kept but have new options. Endpoints
+# whose type, address, port... changed are removed and created again, the
+# others are left open. Connections are not compared, see reload()
+def diff(configuration):
+	wanted = dict((endpoint_json['id'], endpoint_json)
+				for endpoint_json in configuration['endpoints'])
+	
+	remove = []
+	create = []
+	update = []
+	for endpoint in endpoints:
+		endpoint_json = wanted.get(endpoint.id)
+		if endpoint_json is None:
+			remove.append(endpoint.id)
+		elif not endpoint.same(endpoint_json):
+			remove.append(endpoint.id)
+			create.append(endpoint_json)
+		else:
+			current = endpoint.to_json()
+			del current['connections']
+			entry = dict((key, value) for key, value in endpoint_json.items()
+						if key not in ('connections', 'request'))
+			if entry != current:
+				update.append((endpoint, endpoint_json))
+	
+	for endpoint_json in configuration['endpoints']:
+		if endpoint_json['id'] not in index:
+			create.append(endpoint_json)
+	
+	return remove, create, update
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+
+import framing
+
+# settings of a filtered connection in routing.conf:
+#
+#	"connections": ["gcs", {"id": "backup", "allow": [0, 1, 30, 33],
+#							"rates": {"30": 2}}]
+#
+# allow: message ids passed, everything else is dropped (all by default)
+# deny: message ids dropped
+# rates: message id -> most frames per second passed
+KEYS = ('allow', 'deny', 'rates')
+
+# message ids with an entry in the lookup table, larger (mavlink 2) ids
+# are looked up in a dict
+TABLE_SIZE = 1024
+
+# verdicts in the lookup table
+PASS = 0
+DROP = 1
+LIMIT = 2
+
+
+# the filter settings in a connection entry or request, None if it has none
+def settings(entry):
+	if not isinstance(entry, dict):
+		return None
+	found = dict((key, entry[key]) for key in KEYS if key in entry)
+	return found or None
+
+
+# mavlink message filter of one route: allow and deny lists and per message
+# rate limits, compiled into a table indexed by message id so each frame
+# costs one lookup
+class Filter(object):
+
+	def __init__(self, settings):
+		self.settings = settings
+		allow = settings.get('allow')
+		deny = set(int(message) for message in settings.get('deny', ()))
+		# message id -> seconds between frames
+		self.intervals = {}
+		for message, rate in settings.get('rates', {}).items():
+			if float(rate) <= 0:
+				raise ValueError("rate of message %s must be positive" % message)
+			self.intervals[int(message)] = 1.0 / float(rate)
+
+		# what happens to messages that are not listed
+		self.default = PASS
+		listed = set(deny) | set(self.intervals)
+		if allow is not None:
+			self.default = DROP
+			allow = set(int(message) for message in allow)
+			listed |= allow
+
+		self.table = bytearray([self.default]) * TABLE_SIZE
+		self.large = {}
+		for message in listed:
+			if message in deny or (allow is not None and message not in allow):
+				verdict = DROP
+			elif message in self.intervals:
+				verdict = LIMIT
+			else:
+				verdict = PASS
+			if 0 <= message < TABLE_SIZE:
+				self.table[message] = verdict
+			else:
+				self.large[message] = verdict
+
+		# message id -> when the next rate limited frame may pass
+		self.due = {}
+		# frames dropped
+		self.dropped = 0
+
+
+	# does a whole mavlink frame pass
+	def admit(self, frame, now):
+		message = framing.header(frame)[3]
+		if message < TABLE_SIZE:
+			verdict = self.table[message]
+		else:
+			verdict = self.large.get(message, self.default)
+
+		if verdict == PASS:
+			return True
+		if verdict == LIMIT:
+			interval = self.intervals[message]
+			due = self.due.get(message, 0)
+			if now >= due:
+				# counted from this frame: a message that was quiet for a
+				# while doesn't earn a burst of them
+				self.due[message] = now + interval
+				return True
+		self.dropped += 1
+		return False
+
+
+	# the frames that pass
+	def select(self, frames, now):
+		return [frame for frame in frames if self.admit(frame, now)]
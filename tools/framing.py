@@ -0,0 +1,371 @@
+#!/usr/bin/python
+
+# start of frame markers
+MAVLINK_V1 = 0xFE
+MAVLINK_V2 = 0xFD
+
+# bytes around the payload: header and checksum, plus the signature on
+# signed mavlink 2 frames
+V1_OVERHEAD = 8
+V2_OVERHEAD = 12
+V2_SIGNATURE = 13
+V2_SIGNED = 0x01
+
+# longest nmea line we wait for, anything longer without a line end is junk
+MAX_LINE = 1024
+
+# a frame seen again within this long is a duplicate (seconds). Sequence
+# numbers wrap every 256 frames of a component, the checksum tells apart
+# the rare repeat of a sequence number this close
+DUPLICATE_WINDOW = 0.5
+
+# frames remembered for duplicate suppression, the oldest are forgotten
+# even inside the window
+DUPLICATE_RING = 4096
+
+# message id -> offsets of target_system and target_component in the
+# payload (wire order, fields sorted by size), None if the message has no
+# target_component. Mavlink 2 drops trailing zeros from the payload, so a
+# target past the end of the payload is 0
+TARGETS = {
+	4: (12, 13),		# PING
+	5: (0, None),		# CHANGE_OPERATOR_CONTROL
+	11: (4, None),		# SET_MODE
+	20: (2, 3),			# PARAM_REQUEST_READ
+	21: (0, 1),			# PARAM_REQUEST_LIST
+	23: (4, 5),			# PARAM_SET
+	37: (4, 5),			# MISSION_REQUEST_PARTIAL_LIST
+	38: (4, 5),			# MISSION_WRITE_PARTIAL_LIST
+	39: (32, 33),		# MISSION_ITEM
+	40: (2, 3),			# MISSION_REQUEST
+	41: (2, 3),			# MISSION_SET_CURRENT
+	43: (0, 1),			# MISSION_REQUEST_LIST
+	44: (2, 3),			# MISSION_COUNT
+	45: (0, 1),			# MISSION_CLEAR_ALL
+	47: (0, 1),			# MISSION_ACK
+	48: (12, None),		# SET_GPS_GLOBAL_ORIGIN
+	51: (2, 3),			# MISSION_REQUEST_INT
+	66: (2, 3),			# REQUEST_DATA_STREAM
+	69: (10, None),		# MANUAL_CONTROL
+	70: (16, 17),		# RC_CHANNELS_OVERRIDE
+	73: (32, 33),		# MISSION_ITEM_INT
+	75: (30, 31),		# COMMAND_INT
+	76: (30, 31),		# COMMAND_LONG
+	77: (8, 9),			# COMMAND_ACK (extension fields)
+	82: (36, 37),		# SET_ATTITUDE_TARGET
+	84: (50, 51),		# SET_POSITION_TARGET_LOCAL_NED
+	86: (50, 51),		# SET_POSITION_TARGET_GLOBAL_INT
+	110: (1, 2),		# FILE_TRANSFER_PROTOCOL
+	117: (4, 5),		# LOG_REQUEST_LIST
+	119: (10, 11),		# LOG_REQUEST_DATA
+	121: (0, 1),		# LOG_ERASE
+	122: (0, 1),		# LOG_REQUEST_END
+	123: (0, 1),		# GPS_INJECT_DATA
+	243: (52, None),	# SET_HOME_POSITION
+	248: (3, 4),		# V2_EXTENSION
+	320: (2, 3),		# PARAM_EXT_REQUEST_READ
+	321: (0, 1),		# PARAM_EXT_REQUEST_LIST
+	323: (0, 1),		# PARAM_EXT_SET
+}
+
+
+# message id -> crc extra, the byte mixed into the checksum for the layout
+# of the message (from the ardupilotmega dialect, which includes common)
+CRC_EXTRA = {
+	0: 50, 1: 124, 2: 137, 4: 237, 5: 217, 6: 104, 7: 119, 11: 89,
+	20: 214, 21: 159, 22: 220, 23: 168, 24: 24, 25: 23, 26: 170, 27: 144,
+	28: 67, 29: 115, 30: 39, 31: 246, 32: 185, 33: 104, 34: 237, 35: 244,
+	36: 222, 37: 212, 38: 9, 39: 254, 40: 230, 41: 28, 42: 28, 43: 132,
+	44: 221, 45: 232, 46: 11, 47: 153, 48: 41, 49: 39, 50: 78, 51: 196,
+	54: 15, 55: 3, 61: 167, 62: 183, 63: 119, 64: 191, 65: 118, 66: 148,
+	67: 21, 69: 243, 70: 124, 73: 38, 74: 20, 75: 158, 76: 152, 77: 143,
+	81: 106, 82: 49, 83: 22, 84: 143, 85: 140, 86: 5, 87: 150, 89: 231,
+	90: 183, 91: 63, 92: 54, 93: 47, 100: 175, 101: 102, 102: 158, 103: 208,
+	104: 56, 105: 93, 106: 138, 107: 108, 108: 32, 109: 185, 110: 84, 111: 34,
+	112: 174, 113: 124, 114: 237, 115: 4, 116: 76, 117: 128, 118: 56, 119: 116,
+	120: 134, 121: 237, 122: 203, 123: 250, 124: 87, 125: 203, 126: 220, 127: 25,
+	128: 226, 129: 46, 130: 29, 131: 223, 132: 85, 133: 6, 134: 229, 135: 203,
+	136: 1, 137: 195, 138: 109, 139: 168, 140: 181, 141: 47, 142: 72, 143: 131,
+	144: 127, 146: 103, 147: 154, 148: 178, 149: 200, 150: 134, 151: 219, 152: 208,
+	153: 188, 154: 84, 155: 22, 156: 19, 157: 21, 158: 134, 160: 78, 161: 68,
+	162: 189, 163: 127, 164: 154, 165: 21, 166: 21, 167: 144, 168: 1, 169: 234,
+	170: 73, 171: 181, 172: 22, 173: 83, 174: 167, 175: 138, 176: 234, 177: 240,
+	178: 47, 179: 189, 180: 52, 181: 174, 182: 229, 183: 85, 184: 159, 185: 186,
+	186: 72, 191: 92, 192: 36, 193: 71, 194: 98, 195: 120, 200: 134, 201: 205,
+	214: 69, 215: 101, 216: 50, 217: 202, 218: 17, 219: 162, 225: 208, 226: 207,
+	230: 163, 231: 105, 232: 151, 233: 35, 234: 150, 235: 179, 241: 90, 242: 104,
+	243: 85, 244: 95, 245: 130, 246: 184, 247: 81, 248: 8, 249: 204, 250: 49,
+	251: 170, 252: 44, 253: 83, 254: 46, 256: 71, 257: 131, 258: 187, 259: 92,
+	260: 146, 261: 179, 262: 12, 263: 133, 264: 49, 265: 26, 266: 193, 267: 35,
+	268: 14, 269: 109, 270: 59, 271: 22, 275: 126, 276: 18, 277: 62, 280: 70,
+	281: 48, 282: 123, 283: 74, 284: 99, 285: 137, 286: 210, 287: 1, 288: 20,
+	295: 234, 296: 158, 299: 19, 301: 243, 310: 28, 311: 95, 320: 243, 321: 88,
+	322: 243, 323: 78, 324: 132, 330: 23, 331: 91, 332: 236, 333: 231, 335: 225,
+	339: 199, 340: 99, 345: 209, 350: 232, 360: 11, 370: 75, 373: 117, 375: 251,
+	376: 199, 385: 147, 386: 132, 387: 4, 388: 8, 390: 156, 9000: 113, 9005: 117,
+	10001: 209, 10002: 186, 10003: 4, 10004: 133, 10005: 103, 10006: 193, 10007: 71, 10008: 240,
+	10151: 195, 11000: 134, 11001: 15, 11002: 234, 11003: 64, 11004: 11, 11005: 93, 11010: 46,
+	11011: 106, 11020: 205, 11030: 144, 11031: 133, 11032: 85, 11033: 195, 11034: 79, 11035: 128,
+	11036: 177, 11037: 130, 11038: 47, 11039: 142, 11040: 132, 11041: 208, 11042: 201, 11043: 193,
+	11044: 189, 11060: 162, 12900: 114, 12901: 254, 12902: 140, 12903: 249, 12904: 77, 12905: 49,
+	12915: 94, 12918: 139, 12919: 7, 12920: 20, 42000: 227, 42001: 239, 50001: 246, 50002: 181,
+	50003: 62, 50004: 240, 50005: 152, 52000: 13, 52001: 239,
+}
+
+
+# crc-16/mcrf4xx (x.25), the mavlink checksum, of every byte value
+def crc_table():
+	table = []
+	for value in range(256):
+		for bit in range(8):
+			value = (value >> 1) ^ 0x8408 if value & 1 else value >> 1
+		table.append(value)
+	return table
+
+CRC_TABLE = crc_table()
+
+
+# (sequence, system id, component id, message id, payload offset, payload
+# length) of a complete frame
+def header(frame):
+	if frame[0] == MAVLINK_V1:
+		return frame[2], frame[3], frame[4], frame[5], 6, frame[1]
+	return (frame[4], frame[5], frame[6], frame[7] | frame[8] << 8 | frame[9] << 16,
+			10, frame[1])
+
+
+# (system id, component id, target system, target component) of a complete
+# frame, the targets are 0 for broadcasts and messages without a target
+def addresses(frame):
+	sequence, system, component, message, start, length = header(frame)
+	offsets = TARGETS.get(message)
+	if offsets is None:
+		return system, component, 0, 0
+
+	target_system = 0
+	target_component = 0
+	if offsets[0] < length:
+		target_system = frame[start + offsets[0]]
+	if offsets[1] is not None and offsets[1] < length:
+		target_component = frame[start + offsets[1]]
+	return system, component, target_system, target_component
+
+
+# (system id, component id, sequence, message id, checksum) of a complete
+# frame, the same for every copy of it
+def identity(frame):
+	sequence, system, component, message, start, length = header(frame)
+	end = start + length
+	return system, component, sequence, message, frame[end] | frame[end + 1] << 8
+
+
+
+# the checksum a complete frame should carry, None for messages we don't
+# know the crc extra of
+def checksum(frame):
+	sequence, system, component, message, start, length = header(frame)
+	extra = CRC_EXTRA.get(message)
+	if extra is None:
+		return None
+	crc = 0xFFFF
+	table = CRC_TABLE
+	for byte in frame[1:start + length]:
+		crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+	return (crc >> 8) ^ table[(crc ^ extra) & 0xFF]
+
+# recently seen mavlink frames by identity, in a fixed size ring so memory
+# and the cost per frame stay the same however much traffic goes through
+class Duplicates(object):
+
+	def __init__(self, size=DUPLICATE_RING, window=DUPLICATE_WINDOW):
+		self.window = window
+		self.ring = [None] * size
+		self.position = 0
+		# identity -> (time seen, ring slot)
+		self.seen = {}
+
+
+	# the frames that are not copies of one seen within the window, the
+	# others are remembered
+	def filter(self, frames, now):
+		fresh = []
+		ring = self.ring
+		seen = self.seen
+		for frame in frames:
+			key = identity(frame)
+			last = seen.get(key)
+			if last is not None and now - last[0] < self.window:
+				continue
+			fresh.append(frame)
+
+			# forget the oldest, unless it was seen again since
+			position = self.position
+			old = ring[position]
+			if old is not None and seen.get(old, (0, -1))[1] == position:
+				del seen[old]
+			ring[position] = key
+			seen[key] = (now, position)
+			self.position = (position + 1) % len(ring)
+		return fresh
+
+
+# size of the complete frame starting at offset, None if there is no frame
+# start there or the header is cut off
+def size(data, offset=0):
+	if offset + 3 > len(data):
+		return None
+	if data[offset] == MAVLINK_V1:
+		return V1_OVERHEAD + data[offset + 1]
+	if data[offset] == MAVLINK_V2:
+		if data[offset + 2] & V2_SIGNED:
+			return V2_OVERHEAD + data[offset + 1] + V2_SIGNATURE
+		return V2_OVERHEAD + data[offset + 1]
+	return None
+
+
+# split a chunk that holds nothing but whole mavlink frames (what a mavlink
+# framed endpoint forwards), None if it is anything else
+def split(data):
+	frames = []
+	offset = 0
+	while offset < len(data):
+		n = size(data, offset)
+		if n is None or offset + n > len(data):
+			return None
+		frames.append(data[offset:offset + n])
+		offset += n
+	return frames
+
+
+# split a stream of mavlink v1/v2 into whole frames, bytes in between frames
+# are dropped and partial frames are kept until the rest arrives. A
+# frame followed by the start of the next one is taken as it is, otherwise
+# (at the end of what we have, or junk after it) its checksum has to match,
+# a stray start marker would swallow the real frames after it. Messages we
+# don't know the crc extra of are only taken at the end. A candidate that
+# fails is skipped one byte at a time until we are back in step, checksums
+# of the frames taken are left to the receivers
+class MAVLinkParser(object):
+
+	def __init__(self):
+		self.buffer = bytearray()
+
+
+	# add a chunk of the stream, returns the frames completed by it
+	def feed(self, data):
+		buffer = self.buffer
+		buffer += data
+		frames = []
+		start = 0
+		end = len(buffer)
+
+		while start < end:
+			# next start of frame
+			v1 = buffer.find(b'\xfe', start)
+			v2 = buffer.find(b'\xfd', start)
+			if v1 < 0 and v2 < 0:
+				start = end
+				break
+			if v1 < 0 or (v2 >= 0 and v2 < v1):
+				start = v2
+				if start + 3 > end:
+					break
+				# no other incompatibility flags are defined
+				if buffer[start + 2] & ~V2_SIGNED:
+					start += 1
+					continue
+				size = V2_OVERHEAD + buffer[start + 1]
+				if buffer[start + 2] & V2_SIGNED:
+					size += V2_SIGNATURE
+			else:
+				start = v1
+				if start + 2 > end:
+					break
+				size = V1_OVERHEAD + buffer[start + 1]
+
+			if start + size > end:
+				break
+
+			# not followed by the next frame: only a good checksum says it is one
+			if start + size == end or buffer[start + size] not in (MAVLINK_V1, MAVLINK_V2):
+				frame = buffer[start:start + size]
+				crc = checksum(frame)
+				if crc is None:
+					valid = start + size == end
+				else:
+					valid = crc == identity(frame)[4]
+				if not valid:
+					start += 1
+					continue
+				frames.append(frame)
+			else:
+				frames.append(buffer[start:start + size])
+			start += size
+
+		del buffer[:start]
+		return frames
+
+
+# split a stream of text into whole lines (nmea sentences), line ends are kept
+class NMEAFramer(object):
+
+	def __init__(self):
+		self.buffer = bytearray()
+
+
+	# add a chunk of the stream, returns the lines completed by it
+	def feed(self, data):
+		buffer = self.buffer
+		buffer += data
+
+		end = buffer.rfind(b'\n')
+		if end < 0:
+			if len(buffer) > MAX_LINE:
+				del buffer[:]
+			return []
+
+		lines = buffer[:end + 1].splitlines(True)
+		del buffer[:end + 1]
+		return lines
+
+
+# framing setting -> framer class, 'raw' forwards chunks as they are read
+FRAMERS = {
+	'raw': None,
+	'mavlink': MAVLinkParser,
+	'nmea-line': NMEAFramer,
+}
+
+
+# a new framer for a framing setting, None for raw
+def framer(name):
+	if name not in FRAMERS:
+		raise ValueError("unknown framing %s" % name)
+	if FRAMERS[name] is None:
+		return None
+	return FRAMERS[name]()
+
+
+# pack whole frames into as few chunks as possible, no chunk bigger than mtu
+# unless a single frame is. Frames are never split across chunks
+def coalesce(frames, mtu):
+	chunks = []
+	run = []
+	size = 0
+	for frame in frames:
+		if run and size + len(frame) > mtu:
+			chunks.append(join(run))
+			run = []
+			size = 0
+		run.append(frame)
+		size += len(frame)
+
+	if run:
+		chunks.append(join(run))
+	return chunks
+
+
+def join(run):
+	if len(run) == 1:
+		return run[0]
+	return bytearray().join(run)
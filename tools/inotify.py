@@ -0,0 +1,83 @@
+#!/usr/bin/python
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+
+# event masks, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+# the watch is gone, with what it watched
+IN_IGNORED = 0x00008000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event, followed by a nul padded name
+EVENT = struct.Struct('iIII')
+
+libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+
+
+# file system change notifications on a non-blocking file descriptor the
+# router or a select loop can wait on
+class Watcher(object):
+
+	def __init__(self):
+		self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if self.fd < 0:
+			error = ctypes.get_errno()
+			raise OSError(error, os.strerror(error))
+		# watch descriptor -> directory
+		self.watches = {}
+
+
+	def fileno(self):
+		return self.fd
+
+
+	# watch a file or directory, events in a directory come with the name of
+	# the file they are about
+	def add(self, path, mask):
+		wd = libc.inotify_add_watch(self.fd, path, mask)
+		if wd < 0:
+			error = ctypes.get_errno()
+			raise OSError(error, os.strerror(error))
+		self.watches[wd] = path
+		return wd
+
+
+	# (path watched, event mask, file name) for every event so far
+	def read(self):
+		events = []
+		while True:
+			try:
+				data = os.read(self.fd, 65536)
+			except OSError as e:
+				if e.errno in (errno.EAGAIN, errno.EINTR):
+					break
+				raise
+			if not data:
+				break
+
+			offset = 0
+			while offset + EVENT.size <= len(data):
+				wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+				offset += EVENT.size
+				name = data[offset:offset + length].rstrip('\0')
+				offset += length
+				events.append((self.watches.get(wd), mask, name))
+				if mask & IN_IGNORED:
+					self.watches.pop(wd, None)
+		return events
+
+
+	def close(self):
+		os.close(self.fd)
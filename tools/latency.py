@@ -0,0 +1,113 @@
+#!/usr/bin/python
+
+import collections
+
+# sub-buckets per power of two, values are kept to within 1/SUB (~6%)
+SUB = 16
+
+# longest latency told apart, anything longer lands in the last bucket
+# (microseconds)
+MAX_LATENCY = 60 * 1000 * 1000
+
+# trace records kept, the oldest are dropped
+TRACE_SIZE = 4096
+
+
+# bucket of a value, linear up to SUB then SUB buckets per power of two
+def bucket(value):
+	if value < SUB:
+		return value
+	shift = value.bit_length() - SUB.bit_length()
+	return (shift + 1) * SUB + (value >> shift) - SUB
+
+
+# the middle of the range of values that land in a bucket
+def value(bucket):
+	if bucket < SUB:
+		return bucket
+	shift = bucket // SUB - 1
+	return ((bucket % SUB + SUB) << shift) + (1 << shift) // 2
+
+
+# hdr style latency histogram, a fixed array of log-linear buckets so
+# memory doesn't grow with the number of samples. Values in microseconds
+class Histogram(object):
+
+	def __init__(self):
+		self.counts = [0] * (bucket(MAX_LATENCY) + 1)
+		self.count = 0
+		self.max = 0
+
+
+	# add a latency in seconds
+	def add(self, seconds):
+		microseconds = int(seconds * 1000000)
+		if microseconds < 0:
+			microseconds = 0
+		elif microseconds > MAX_LATENCY:
+			microseconds = MAX_LATENCY
+		self.counts[bucket(microseconds)] += 1
+		self.count += 1
+		if microseconds > self.max:
+			self.max = microseconds
+
+
+	# the latency below which this fraction of the samples fall
+	def percentile(self, fraction):
+		if self.count == 0:
+			return 0
+		rank = fraction * self.count
+		seen = 0
+		for i, n in enumerate(self.counts):
+			seen += n
+			if seen >= rank and n:
+				return min(value(i), self.max)
+		return self.max
+
+
+	def summary(self):
+		return {"count": self.count,
+				"p50": self.percentile(0.50),
+				"p95": self.percentile(0.95),
+				"p99": self.percentile(0.99),
+				"max": self.max}
+
+
+# samples one batch in every so many into a bounded ring of per packet
+# timings, off until enabled with a sampling interval
+class Tracer(object):
+
+	def __init__(self, size=TRACE_SIZE):
+		# trace one batch in this many, 0 for off
+		self.every = 0
+		self.countdown = 0
+		self.records = collections.deque(maxlen=size)
+
+
+	def enable(self, every):
+		self.every = every
+		self.countdown = every
+
+
+	# should the batch being forwarded be traced
+	def sample(self):
+		self.countdown -= 1
+		if self.countdown > 0:
+			return False
+		self.countdown = self.every
+		return True
+
+
+	def record(self, start, source, target, packets, size, seconds):
+		self.records.append([start, source, target, packets, size, int(seconds * 1000000)])
+
+
+	# the records so far, oldest first, and forget them
+	def dump(self):
+		records = list(self.records)
+		self.records.clear()
+		return records
+
+
+# the tracer for the whole process
+tracer = Tracer()
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+
+import json
+import os
+import threading
+import time
+
+# longest a change waits before it is written out (seconds), changes that
+# come in the meantime go out with it
+DELAY = 1.0
+
+
+# the file contents of a configuration
+def dumps(configuration):
+	return json.dumps(configuration, indent=4)
+
+
+# replace a file with the configuration so that a power cut leaves either
+# the old file or the new one, never half of one
+def write(filename, configuration):
+	return replace(filename, dumps(configuration))
+
+
+def replace(filename, data):
+	temporary = filename + '.tmp'
+	f = open(temporary, 'w')
+	f.write(data)
+	f.flush()
+	os.fsync(f.fileno())
+	f.close()
+	os.rename(temporary, filename)
+
+	# and the rename itself
+	directory = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+	try:
+		os.fsync(directory)
+	finally:
+		os.close(directory)
+	return data
+
+
+# writes the configuration to a file from a background thread, at most once
+# per DELAY however often it changes, so saving never holds up forwarding
+class Persister(object):
+
+	def __init__(self, filename, delay=DELAY):
+		self.filename = filename
+		self.delay = delay
+		# the configuration waiting to be written, None if it is written
+		self.configuration = None
+		self.due = 0
+		self.condition = threading.Condition()
+		# what we last wrote, to tell our own changes to the file from others.
+		# Set before the file is replaced, a watcher may see the new file
+		# before replace() returns
+		self.written = None
+
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+
+	# write this configuration soon. It must be a snapshot that nothing else
+	# changes, see endpoint.snapshot()
+	def save(self, configuration):
+		with self.condition:
+			if self.configuration is None:
+				self.due = time.time() + self.delay
+			self.configuration = configuration
+			self.condition.notify()
+
+
+	def run(self):
+		while True:
+			with self.condition:
+				while self.configuration is None:
+					self.condition.wait()
+				while time.time() < self.due:
+					self.condition.wait(self.due - time.time())
+				configuration = self.configuration
+				self.configuration = None
+
+			try:
+				data = dumps(configuration)
+				self.written = data
+				replace(self.filename, data)
+			except Exception as e:
+				print("Error saving %s: %s") % (self.filename, e)
@@ -0,0 +1,339 @@
+#!/usr/bin/python
+
+# Throughput and latency benchmark for the router (endpoint.py, router.py).
+# Builds the topology of a routing.conf style file with stand-ins for the
+# hardware: every serial endpoint gets a pseudo-terminal in place of its
+# port, every udp endpoint gets a loopback socket as its peer. A mix of
+# mavlink telemetry is fed into the source endpoint at increasing rates,
+# and what comes out of the other stand-ins is counted and timed.
+
+import argparse
+import fcntl
+import json
+import os
+import pty
+import random
+import select
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tty
+
+import framing
+import latency
+
+parser = argparse.ArgumentParser(description="Router throughput and latency benchmark")
+parser.add_argument('--config', action="store", type=str, default=None, help="routing.conf style topology, a serial autopilot and two udp gcs by default")
+parser.add_argument('--source', action="store", type=str, default=None, help="id of the endpoint traffic is fed into, the first serial endpoint by default")
+parser.add_argument('--rates', action="store", type=str, default="500,1000,2000,5000,10000,20000", help="comma separated packet rates to run")
+parser.add_argument('--duration', action="store", type=float, default=5.0, help="seconds to run each rate")
+parser.add_argument('--max-drop', action="store", type=float, default=0.01, help="highest drop rate that still counts as sustained")
+parser.add_argument('--output', action="store", type=str, default="router-benchmark.json", help="file the results are written to")
+parser.add_argument('--serve', action="store", type=str, default=None, help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+# topology used without --config
+DEFAULT_CONFIG = {"endpoints": [
+    {"id": "autopilot", "type": "serial", "port": "/dev/ttyACM0", "baudrate": 115200, "connections": ["gcs1", "gcs2"]},
+    {"id": "gcs1", "type": "udp", "ip": "127.0.0.1", "port": 24550, "connections": ["autopilot"]},
+    {"id": "gcs2", "type": "udp", "ip": "127.0.0.1", "port": 24551, "connections": ["autopilot"]},
+]}
+
+# (message id, payload length, weight) of the telemetry an ArduSub
+# autopilot streams to the surface
+MIX = [
+    (30, 28, 10),   # ATTITUDE
+    (29, 14, 5),    # SCALED_PRESSURE
+    (33, 28, 4),    # GLOBAL_POSITION_INT
+    (36, 21, 4),    # SERVO_OUTPUT_RAW
+    (65, 42, 4),    # RC_CHANNELS
+    (74, 20, 4),    # VFR_HUD
+    (251, 18, 2),   # NAMED_VALUE_FLOAT
+    (1, 31, 1),     # SYS_STATUS
+    (22, 25, 1),    # PARAM_VALUE
+    (0, 9, 1),      # HEARTBEAT
+]
+
+# send time and sequence number, at the start of every payload
+STAMP = struct.Struct('<dI')
+
+# how often the feeder wakes up to send (seconds)
+TICK = 0.001
+
+# how long to wait for stragglers after each rate (seconds)
+DRAIN = 0.5
+
+
+# run the router on a configuration file, the benchmark runs this in a
+# separate process
+def serve(filename):
+    import endpoint
+    import router
+    import shard
+
+    endpoint.load(filename)
+    _router = router.Router(endpoint.endpoints)
+    shard.Shards(_router).start()
+    _router.run()
+
+
+# a mavlink 1 frame of the mix, stamped with its send time
+def frame(message, length, sequence, now):
+    length = max(length, STAMP.size)
+    data = bytearray(framing.V1_OVERHEAD + length)
+    data[0] = framing.MAVLINK_V1
+    data[1] = length
+    data[2] = sequence & 0xFF
+    data[3] = 1
+    data[4] = 1
+    data[5] = message
+    STAMP.pack_into(data, 6, now, sequence)
+    # the router's parser checks it on frames it can't tell apart from junk
+    # otherwise
+    crc = framing.checksum(data)
+    data[-2] = crc & 0xFF
+    data[-1] = crc >> 8
+    return data
+
+
+# a serial endpoint's pseudo-terminal, or a udp endpoint's peer socket
+class StandIn(object):
+
+    def __init__(self, configuration):
+        self.id = configuration['id']
+        self.type = configuration['type']
+        self.parser = framing.MAVLinkParser()
+        self.received = 0
+        self.histogram = latency.Histogram()
+
+        if self.type == 'serial':
+            self.master, self.slave = pty.openpty()
+            tty.setraw(self.slave)
+            configuration['port'] = os.ttyname(self.slave)
+            self.fd = self.master
+            self.pending = bytearray()
+            self.socket = None
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+            if configuration['ip'] == '0.0.0.0':
+                # the router is the server, it learns us when we send to it
+                self.socket.bind(('127.0.0.1', 0))
+                self.address = ('127.0.0.1', int(configuration['port']))
+            else:
+                self.socket.bind((configuration['ip'], int(configuration['port'])))
+                self.address = None
+            self.fd = self.socket.fileno()
+
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, fcntl.fcntl(self.fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+    def fileno(self):
+        return self.fd
+
+
+    # introduce ourselves to a udp server endpoint
+    def hello(self):
+        if self.socket is not None and self.address is not None:
+            self.socket.sendto(b'', self.address)
+
+
+    # False if the frame couldn't be sent, a pty that only takes part of a
+    # frame gets the rest before anything else
+    def send(self, data):
+        try:
+            if self.socket is None:
+                if self.pending:
+                    del self.pending[:os.write(self.fd, self.pending)]
+                    if self.pending:
+                        return False
+                self.pending += data[os.write(self.fd, data):]
+                return True
+            if self.address is None:
+                return False
+            self.socket.sendto(data, self.address)
+            return True
+        except (OSError, socket.error) as e:
+            return False
+
+
+    def receive(self, now):
+        while True:
+            try:
+                if self.socket is None:
+                    data = os.read(self.fd, 65536)
+                else:
+                    data = self.socket.recv(65536)
+            except (OSError, socket.error) as e:
+                return
+            if not data:
+                return
+
+            for data in self.parser.feed(data):
+                if len(data) < 6 + STAMP.size:
+                    continue
+                sent, sequence = STAMP.unpack_from(bytes(data), 6)
+                self.received += 1
+                self.histogram.add(now - sent)
+
+
+    def reset(self):
+        self.received = 0
+        self.histogram = latency.Histogram()
+
+
+# seconds of cpu the process has used
+def cpu_time(pid):
+    f = open('/proc/%d/stat' % pid, 'r')
+    fields = f.read().rsplit(')', 1)[1].split()
+    f.close()
+    # utime and stime, fields 14 and 15 counting from 1
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+
+# feed the source at a rate for a while, counting what comes out of the sinks
+def run(rate, source, sinks, pid, duration):
+    for sink in sinks:
+        sink.reset()
+
+    choices = []
+    for message, length, weight in MIX:
+        choices += [(message, length)] * weight
+
+    sent = 0
+    refused = 0
+    sequence = 0
+    credit = 0.0
+    start = time.time()
+    cpu_start = cpu_time(pid)
+    last = start
+    end = start + duration
+    fds = dict((sink.fileno(), sink) for sink in sinks)
+
+    while True:
+        now = time.time()
+        if now >= end + DRAIN:
+            break
+
+        if now < end:
+            credit += (now - last) * rate
+            while credit >= 1:
+                message, length = random.choice(choices)
+                if source.send(frame(message, length, sequence, time.time())):
+                    sent += 1
+                else:
+                    refused += 1
+                sequence += 1
+                credit -= 1
+        last = now
+
+        readable, writable, exceptional = select.select(list(fds), [], [], TICK)
+        now = time.time()
+        for fd in readable:
+            fds[fd].receive(now)
+
+    cpu = cpu_time(pid) - cpu_start
+    expected = sent * len(sinks)
+    received = sum(sink.received for sink in sinks)
+
+    histogram = latency.Histogram()
+    for sink in sinks:
+        for i, n in enumerate(sink.histogram.counts):
+            histogram.counts[i] += n
+        histogram.count += sink.histogram.count
+        histogram.max = max(histogram.max, sink.histogram.max)
+
+    return {"rate": rate,
+            "sent": sent,
+            "sent_rate": sent / duration,
+            "refused": refused,
+            "expected": expected,
+            "received": received,
+            "drop_rate": 1.0 - float(received) / expected if expected else 0.0,
+            "latency_us": histogram.summary(),
+            "cpu_us_per_packet": cpu * 1000000 / sent if sent else 0.0,
+            "sinks": dict((sink.id, sink.received) for sink in sinks)}
+
+
+def main():
+    if args.config is not None:
+        f = open(args.config, 'r')
+        configuration = json.load(f)
+        f.close()
+    else:
+        configuration = DEFAULT_CONFIG
+
+    standins = {}
+    for _endpoint in configuration['endpoints']:
+        if _endpoint['type'] in ('serial', 'udp'):
+            standins[_endpoint['id']] = StandIn(_endpoint)
+
+    source_id = args.source
+    if source_id is None:
+        serial = [_endpoint['id'] for _endpoint in configuration['endpoints'] if _endpoint['type'] == 'serial']
+        if not serial:
+            print 'no serial endpoint to feed, pick a --source'
+            sys.exit(1)
+        source_id = serial[0]
+
+    source = standins.get(source_id)
+    if source is None:
+        print 'source %s must be a serial or udp endpoint' % source_id
+        sys.exit(1)
+
+    connections = [_endpoint['connections'] for _endpoint in configuration['endpoints'] if _endpoint['id'] == source_id][0]
+    # filtered connections are {"id": ...}
+    connections = [target['id'] if isinstance(target, dict) else target for target in connections]
+    sinks = [standins[target] for target in connections if target in standins]
+    if not sinks:
+        print '%s is not connected to any serial or udp endpoint' % source_id
+        sys.exit(1)
+
+    # the router gets the topology with the stand-ins in place
+    f = tempfile.NamedTemporaryFile(suffix='.conf', delete=False)
+    json.dump(configuration, f)
+    f.close()
+
+    router = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', f.name],
+                              stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    try:
+        time.sleep(1.0)
+        for standin in standins.values():
+            standin.hello()
+        time.sleep(0.1)
+
+        results = []
+        for rate in [float(rate) for rate in args.rates.split(',')]:
+            result = run(rate, source, sinks, router.pid, args.duration)
+            results.append(result)
+            print '%8d pkt/s: sent %8.0f pkt/s, %5.2f%% dropped, p50 %6d us, p99 %6d us, max %7d us, %5.1f us cpu/pkt' % (
+                rate, result['sent_rate'], result['drop_rate'] * 100, result['latency_us']['p50'],
+                result['latency_us']['p99'], result['latency_us']['max'], result['cpu_us_per_packet'])
+    finally:
+        router.terminate()
+        router.wait()
+        os.unlink(f.name)
+
+    sustained = [result['sent_rate'] for result in results if result['drop_rate'] <= args.max_drop]
+
+    f = open(args.output, 'w')
+    json.dump({"time": time.time(),
+               "python": sys.version.split()[0],
+               "source": source_id,
+               "sinks": [sink.id for sink in sinks],
+               "duration": args.duration,
+               "max_drop": args.max_drop,
+               "max_sustained_rate": max(sustained) if sustained else 0.0,
+               "configuration": configuration,
+               "results": results}, f, indent=4)
+    f.close()
+    print 'max sustained rate %.0f pkt/s, results in %s' % (max(sustained) if sustained else 0.0, args.output)
+
+
+if args.serve is not None:
+    serve(args.serve)
+else:
+    main()
@@ -0,0 +1,286 @@
+#!/usr/bin/python
+
+import collections
+import fcntl
+import os
+import select
+import time
+import traceback
+import endpoint
+import inotify
+
+# how often to retry opening serial ports that are not present (seconds)
+RETRY_INTERVAL = 1.0
+
+# where device nodes of serial ports show up. The subdirectories come and
+# go with the devices, they are watched whenever they exist
+DEVICE_DIRECTORIES = ['/dev', '/dev/serial', '/dev/serial/by-id']
+
+
+# wait for readiness on many file descriptors at once
+class Poller(object):
+
+	def __init__(self):
+		if hasattr(select, 'epoll'):
+			self.poller = select.epoll()
+			self.scale = 1.0
+		else:
+			self.poller = select.poll()
+			self.scale = 1000.0
+
+
+	def register(self, fd, mask=select.POLLIN):
+		self.poller.register(fd, mask)
+
+
+	def modify(self, fd, mask):
+		self.poller.modify(fd, mask)
+
+
+	def unregister(self, fd):
+		try:
+			self.poller.unregister(fd)
+		# the descriptor may already be closed
+		except Exception as e:
+			pass
+
+
+	# timeout in seconds, None to wait forever
+	def poll(self, timeout=None):
+		if timeout is None:
+			timeout = -1
+		else:
+			# epoll rounds timeouts down to whole milliseconds, shorter ones
+			# (udp coalescing) would spin. The epoll descriptor is readable
+			# when there are events, select waits on it to the microsecond
+			if 0 < timeout < 0.001 and hasattr(self.poller, 'fileno'):
+				try:
+					select.select([self.poller.fileno()], [], [], timeout)
+				except (IOError, select.error) as e:
+					pass
+				timeout = 0
+			timeout = timeout * self.scale
+		try:
+			return self.poller.poll(timeout)
+		# interrupted by a signal
+		except (IOError, select.error) as e:
+			return []
+
+
+# event loop forwarding traffic between a set of endpoints, data is forwarded
+# as soon as it arrives and we sleep while the links are quiet
+class Router(object):
+
+	def __init__(self, endpoints):
+		# the endpoints serviced by this loop
+		self.endpoints = endpoints
+		self.poller = Poller()
+		# file descriptor -> what we are waiting on: endpoints, or parts of
+		# them (tcp connections), see Endpoint.pollables()
+		self.registered = {}
+		# file descriptor -> callback, for everything else (control socket...)
+		self.handlers = {}
+		# some endpoints could not be opened, retry them periodically
+		self.waiting = False
+		self.last_retry = 0
+		# endpoints we are waiting on to become writable
+		self.writing = set()
+		# callbacks handed over by other threads, see call()
+		self.calls = collections.deque()
+		self.wakeup, self.notify = os.pipe()
+		for fd in (self.wakeup, self.notify):
+			fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+		self.watch(self.wakeup, self.called)
+
+		# device nodes appearing, serial ports waiting for them are opened
+		# right away instead of at the next retry
+		self.hotplug = None
+		try:
+			self.hotplug = inotify.Watcher()
+			self.watch_devices()
+			self.watch(self.hotplug.fileno(), self.plugged)
+		except Exception as e:
+			self.hotplug = None
+
+
+	def watch(self, fd, callback):
+		self.handlers[fd] = callback
+		self.poller.register(fd)
+
+
+	def unwatch(self, fd):
+		if self.handlers.pop(fd, None) is not None:
+			self.poller.unregister(fd)
+
+
+	# run a callback in the loop, between two rounds of forwarding. This is
+	# the only Router method other threads may use
+	def call(self, callback):
+		self.calls.append(callback)
+		try:
+			os.write(self.notify, '\0')
+		# the pipe is full, the loop has plenty of wakeups pending
+		except OSError as e:
+			pass
+
+
+	def called(self):
+		try:
+			while os.read(self.wakeup, 4096):
+				pass
+		except OSError as e:
+			pass
+
+		while self.calls:
+			self.calls.popleft()()
+
+
+	# bring the poller in line with the current endpoints, call this after
+	# anything that opens or closes an endpoint
+	def sync(self):
+		wanted = {}
+		for _endpoint in self.endpoints:
+			for pollable in _endpoint.pollables():
+				fd = pollable.fileno()
+				if fd is not None:
+					wanted[fd] = pollable
+
+		for fd, _endpoint in self.registered.items():
+			if wanted.get(fd) is not _endpoint:
+				self.poller.unregister(fd)
+
+		for fd, _endpoint in wanted.items():
+			if self.registered.get(fd) is not _endpoint:
+				self.poller.register(fd, self.mask(_endpoint))
+
+		self.registered = wanted
+		self.writing = set(endpoint.backlogged)
+
+
+	def mask(self, _endpoint):
+		if _endpoint in endpoint.backlogged:
+			return select.POLLIN | select.POLLOUT
+		return select.POLLIN
+
+
+	# wait for writability on the endpoints that have buffered output, and
+	# only on those
+	def backlog(self):
+		for _endpoint in endpoint.backlogged ^ self.writing:
+			fd = _endpoint.fileno()
+			if self.registered.get(fd) is _endpoint:
+				self.poller.modify(fd, self.mask(_endpoint))
+		self.writing = set(endpoint.backlogged)
+
+
+	def watch_devices(self):
+		watched = set(self.hotplug.watches.values())
+		for directory in DEVICE_DIRECTORIES:
+			if directory not in watched and os.path.isdir(directory):
+				try:
+					self.hotplug.add(directory, inotify.IN_CREATE | inotify.IN_ATTRIB | inotify.IN_MOVED_TO)
+				except OSError as e:
+					pass
+
+
+	# something changed in the device directories
+	def plugged(self):
+		self.hotplug.read()
+		self.watch_devices()
+		if not self.waiting:
+			return
+
+		for _endpoint in self.endpoints:
+			if _endpoint.fileno() is None and hasattr(_endpoint, 'wake'):
+				_endpoint.wake()
+		self.retry()
+
+
+	# try to open endpoints that are closed (serial ports that are not present)
+	def retry(self):
+		self.waiting = False
+		for _endpoint in self.endpoints:
+			if _endpoint.fileno() is None and hasattr(_endpoint, 'open'):
+				if not _endpoint.open():
+					self.waiting = True
+		# counted from after the attempts, so the ports are due next time
+		self.last_retry = time.time()
+		self.sync()
+
+
+	# service a new set of endpoints, or the same set after a topology change
+	def update(self, endpoints=None):
+		if endpoints is not None:
+			self.endpoints = endpoints
+		self.retry()
+
+
+	# wait for and handle one round of events, for at most timeout seconds.
+	# An endpoint that raises is reported, it doesn't stop the others
+	def step(self, timeout=None):
+		try:
+			self.round(timeout)
+		except Exception as e:
+			print("Error forwarding: %s") % e
+			traceback.print_exc()
+
+
+	def round(self, timeout):
+		now = time.time()
+		deadlines = [_endpoint.deadline() for _endpoint in endpoint.pending]
+
+		# wake up now and then to retry opening serial ports that are not present
+		if self.waiting:
+			deadlines.append(self.last_retry + RETRY_INTERVAL)
+
+		# and when held back data can go out
+		for deadline in deadlines:
+			if deadline is not None:
+				deadline = max(0, deadline - now)
+				if timeout is None or deadline < timeout:
+					timeout = deadline
+
+		if endpoint.backlogged != self.writing:
+			self.backlog()
+
+		for fd, event in self.poller.poll(timeout):
+			callback = self.handlers.get(fd)
+			if callback is not None:
+				callback()
+				continue
+
+			_endpoint = self.registered.get(fd)
+			if _endpoint is None:
+				continue
+
+			if event & select.POLLOUT:
+				_endpoint.write_ready()
+
+			# read and write all routes for this endpoint
+			if event & ~select.POLLOUT and _endpoint.fileno() == fd:
+				_endpoint.read()
+
+			# the endpoint was closed on error, stop waiting on it
+			if _endpoint.fileno() != fd:
+				self.waiting = True
+				self.sync()
+
+		# tcp connections came or went
+		if endpoint.changed:
+			endpoint.changed.clear()
+			self.retry()
+
+		if self.waiting and time.time() - self.last_retry >= RETRY_INTERVAL:
+			self.retry()
+
+		if endpoint.pending:
+			now = time.time()
+			for _endpoint in list(endpoint.pending):
+				deadline = _endpoint.deadline()
+				if deadline is None or deadline <= now:
+					_endpoint.flush()
+
+
+	def run(self):
+		while True:
+			self.step()
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+
+import collections
+import time
+import framing
+
+# priority classes, lower goes first
+CONTROL = 0
+NORMAL = 1
+BULK = 2
+
+# mavlink message id -> priority class, anything else is NORMAL
+PRIORITIES = {
+	0: CONTROL,		# HEARTBEAT
+	11: CONTROL,	# SET_MODE
+	69: CONTROL,	# MANUAL_CONTROL
+	70: CONTROL,	# RC_CHANNELS_OVERRIDE
+	75: CONTROL,	# COMMAND_INT
+	76: CONTROL,	# COMMAND_LONG
+	77: CONTROL,	# COMMAND_ACK
+	82: CONTROL,	# SET_ATTITUDE_TARGET
+	84: CONTROL,	# SET_POSITION_TARGET_LOCAL_NED
+	86: CONTROL,	# SET_POSITION_TARGET_GLOBAL_INT
+	22: BULK,		# PARAM_VALUE
+	39: BULK,		# MISSION_ITEM
+	73: BULK,		# MISSION_ITEM_INT
+	110: BULK,		# FILE_TRANSFER_PROTOCOL
+	118: BULK,		# LOG_ENTRY
+	120: BULK,		# LOG_DATA
+	130: BULK,		# DATA_TRANSMISSION_HANDSHAKE
+	131: BULK,		# ENCAPSULATED_DATA
+	184: BULK,		# REMOTE_LOG_DATA_BLOCK
+	322: BULK,		# PARAM_EXT_VALUE
+}
+
+# bytes queued per priority class before the oldest frames are shed
+QUEUE = 32768
+
+
+# outbound queue for a rate limited link: one bounded queue per priority
+# class drained by a token bucket, so control traffic always goes out first
+# and bulk traffic waits (or is shed) while the link is saturated
+class Shaper(object):
+
+	def __init__(self, rate, burst=None, limit=QUEUE, priorities=None):
+		# bytes per second
+		self.rate = float(rate)
+		# most bytes sent back to back after the link has been idle, at
+		# least one full mavlink frame
+		if burst is None:
+			burst = max(int(rate) // 20, 280)
+		self.burst = burst
+		self.limit = limit
+		self.priorities = dict(PRIORITIES)
+		for message, priority in (priorities or {}).items():
+			self.priorities[int(message)] = int(priority)
+
+		self.queues = [collections.deque() for priority in (CONTROL, NORMAL, BULK)]
+		self.sizes = [0, 0, 0]
+		self.tokens = float(self.burst)
+		self.last = time.time()
+		# bytes shed because a queue was full
+		self.drops = 0
+
+
+	def empty(self):
+		return not any(self.sizes)
+
+
+	# bytes waiting
+	def depth(self):
+		return sum(self.sizes)
+
+
+	# queue a chunk, frame by frame if it holds whole mavlink frames
+	def put(self, data):
+		# the data may be a view of a receive buffer, keep a copy
+		data = bytearray(data)
+		frames = framing.split(data)
+		if frames is None:
+			self.queue(NORMAL, data)
+			return
+
+		for frame in frames:
+			message = framing.header(frame)[3]
+			self.queue(self.priorities.get(message, NORMAL), frame)
+
+
+	def queue(self, priority, data):
+		priority = min(max(priority, CONTROL), BULK)
+		queue = self.queues[priority]
+		queue.append(data)
+		self.sizes[priority] += len(data)
+		while self.sizes[priority] > self.limit:
+			shed = queue.popleft()
+			self.sizes[priority] -= len(shed)
+			self.drops += len(shed)
+
+
+	def refill(self, now):
+		self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+		self.last = now
+
+
+	# next chunk to send, highest priority first and packed up to mtu, None
+	# if the queues are empty or we are out of tokens
+	def take(self, now, mtu):
+		self.refill(now)
+		if self.tokens <= 0:
+			return None
+
+		chunk = None
+		for priority, queue in enumerate(self.queues):
+			while queue and (chunk is None or len(chunk) + len(queue[0]) <= mtu):
+				data = queue.popleft()
+				self.sizes[priority] -= len(data)
+				if chunk is None:
+					chunk = data
+				else:
+					chunk += data
+			if chunk is not None and queue:
+				break
+
+		if chunk is not None:
+			# may go negative for a big chunk, the debt delays the next one
+			self.tokens -= len(chunk)
+		return chunk
+
+
+	# when take() will have something to send, None if nothing is queued
+	def deadline(self):
+		if self.empty():
+			return None
+		if self.tokens > 0:
+			return self.last
+		return self.last + (1 - self.tokens) / self.rate
@@ -0,0 +1,362 @@
+#!/usr/bin/python
+
+import ctypes
+import fcntl
+import json
+import mmap
+import multiprocessing
+import os
+import struct
+import endpoint
+import router
+
+# bytes of shared memory in each ring
+RING_SIZE = 1 << 20
+
+# head and tail counters at the start of the shared memory
+HEADER = struct.Struct('<QQ')
+COUNTER = struct.Struct('<Q')
+
+# every frame is prefixed with its length and the number of its target, see
+# Shards.numbers
+RECORD = struct.Struct('<IH')
+
+# length marking the end of the ring as unused, the next frame is at 0
+WRAP = 0xFFFFFFFF
+
+
+# single producer, single consumer ring of frames in shared memory. The
+# producer only moves head and the consumer only moves tail, so there is no
+# locking. A pipe wakes the consumer up, once per batch of frames
+class Ring(object):
+
+	def __init__(self, size=RING_SIZE):
+		self.size = size
+		# anonymous shared mapping, inherited by the worker processes
+		self.memory = mmap.mmap(-1, HEADER.size + size)
+		self.view = memoryview((ctypes.c_char * (HEADER.size + size)).from_buffer(self.memory))
+		self.wakeup, self.notify = os.pipe()
+		for fd in (self.wakeup, self.notify):
+			fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+		# frames that did not fit
+		self.drops = 0
+
+
+	def fileno(self):
+		return self.wakeup
+
+
+	# producer side, False if the frame was dropped because the ring is full
+	def push(self, target, data):
+		n = len(data)
+		head, tail = HEADER.unpack_from(self.memory, 0)
+		position = head % self.size
+
+		# frames are never split, skip to the start if this one doesn't fit
+		skip = 0
+		if position + RECORD.size + n > self.size:
+			skip = self.size - position
+
+		if skip + RECORD.size + n > self.size - (head - tail):
+			self.drops += 1
+			return False
+
+		if skip:
+			if skip >= RECORD.size:
+				RECORD.pack_into(self.memory, HEADER.size + position, WRAP, 0)
+			head += skip
+			position = 0
+
+		start = HEADER.size + position
+		RECORD.pack_into(self.memory, start, n, target)
+		start += RECORD.size
+		self.view[start:start + n] = data
+
+		# publish
+		COUNTER.pack_into(self.memory, 0, head + RECORD.size + n)
+		return True
+
+
+	# wake the consumer up
+	def signal(self):
+		try:
+			os.write(self.notify, '\0')
+		# the pipe is full, the consumer has plenty of wakeups pending
+		except OSError as e:
+			pass
+
+
+	# consumer side, yields (target, data) for every frame published so far.
+	# data is a view of the ring, only valid until the next frame is taken
+	def pop(self):
+		try:
+			while os.read(self.wakeup, 4096):
+				pass
+		except OSError as e:
+			pass
+
+		head, tail = HEADER.unpack_from(self.memory, 0)
+		while tail < head:
+			position = tail % self.size
+			if self.size - position < RECORD.size:
+				tail += self.size - position
+				continue
+
+			n, target = RECORD.unpack_from(self.memory, HEADER.size + position)
+			if n == WRAP:
+				tail += self.size - position
+				continue
+
+			start = HEADER.size + position + RECORD.size
+			yield target, self.view[start:start + n]
+
+			tail += RECORD.size + n
+			COUNTER.pack_into(self.memory, COUNTER.size, tail)
+
+		COUNTER.pack_into(self.memory, COUNTER.size, tail)
+
+
+	def close(self):
+		os.close(self.wakeup)
+		os.close(self.notify)
+
+
+# stands in for an endpoint that runs in another shard, writes go through
+# the ring towards that shard. Frames are packed for the target's mtu, its
+# rate limit is applied where it runs, see deliver()
+class RingEndpoint(endpoint.Endpoint):
+
+	def __init__(self, target, number, ring):
+		endpoint.Endpoint.__init__(self, target.id, 'ring', [])
+		self.number = number
+		self.ring = ring
+		self.mtu = target.mtu
+
+
+	def write(self, data):
+		self.ring.push(self.number, data)
+		self.ring.signal()
+
+
+	def write_batch(self, batch):
+		for data in batch:
+			self.ring.push(self.number, data)
+		self.ring.signal()
+
+
+# point the routes of the endpoints in this shard at the rings for every
+# target that lives in another shard
+def localize(shard, endpoints, rings, numbers):
+	for _endpoint in endpoints:
+		if _endpoint.shard != shard:
+			continue
+		_endpoint.connections = tuple(target if target.shard == shard
+			else RingEndpoint(target, numbers[target.id], rings[(shard, target.shard)])
+			for target in _endpoint.connections)
+
+
+# write the frames coming out of a ring to their targets, by number. This
+# runs in the target's shard, so a rate limited target queues them in its
+# own shaper like frames from its neighbours
+def deliver(ring, targets):
+	for number, data in ring.pop():
+		target = targets.get(number)
+		if target is not None:
+			target.write_batch([data])
+
+
+# keep only what the endpoints of this process were waiting for. Output the
+# main process was holding back for another shard is not ours to send, but
+# an endpoint that moved here keeps its buffered output and connects in
+# progress
+def adopt(endpoints):
+	endpoints = set(endpoints)
+	for waiting in (endpoint.pending, endpoint.backlogged, endpoint.changed):
+		for item in list(waiting):
+			# tcp and unix connections wait on behalf of their endpoint
+			if getattr(item, 'endpoint', item) not in endpoints:
+				waiting.discard(item)
+
+
+# worker process main loop, forward traffic for the endpoints in one shard
+def work(shard, endpoints, rings, numbers):
+	parent = os.getppid()
+
+	localize(shard, endpoints, rings, numbers)
+	local = [_endpoint for _endpoint in endpoints if _endpoint.shard == shard]
+	adopt(local)
+	for _endpoint in local:
+		_endpoint.forked()
+	targets = dict((numbers[_endpoint.id], _endpoint) for _endpoint in local)
+	_router = router.Router(local)
+	for (source, target), ring in rings.items():
+		if target == shard:
+			_router.watch(ring.fileno(), lambda ring=ring: deliver(ring, targets))
+	_router.update()
+
+	# exit with the main process
+	while os.getppid() == parent:
+		_router.step(1.0)
+
+
+# deploy the endpoints across processes according to their 'shard' setting.
+# Shard 0 runs in the main process on the main router, every other shard
+# gets its own worker process. Frames crossing shards go through
+# shared-memory rings, one per direction for each pair of shards that are
+# connected. Without any shard settings this is just the plain router
+class Shards(object):
+
+	def __init__(self, _router):
+		self.router = _router
+		# shard -> (what it was started with, worker process)
+		self.workers = {}
+		# (source shard, target shard) -> ring
+		self.rings = {}
+		# rings the main process takes frames out of
+		self.watched = []
+		# endpoint id -> number frames for it carry through the rings. An
+		# endpoint keeps its number while it exists, so the shards that
+		# don't change don't have to be told about the others
+		self.numbers = {}
+		# the endpoints deployed
+		self.endpoints = []
+
+
+	def stop(self):
+		for shard in list(self.workers):
+			self.halt(shard)
+
+		self.unwatch()
+		for ring in self.rings.values():
+			ring.close()
+		self.rings = {}
+
+
+	def halt(self, shard):
+		signature, worker = self.workers.pop(shard)
+		worker.terminate()
+		worker.join()
+
+
+	def unwatch(self):
+		for ring in self.watched:
+			self.router.unwatch(ring.fileno())
+		self.watched = []
+
+
+	# (re)deploy a topology, call this after every change. endpoints and
+	# routes are a snapshot taken with endpoint.routes(), the current
+	# configuration if not given. Only the workers of shards whose
+	# endpoints, routes or rings changed are restarted
+	def start(self, endpoints=None, routes=None):
+		if endpoints is None:
+			endpoints = list(endpoint.endpoints)
+			routes = endpoint.routes(endpoints)
+
+		for _endpoint, (connections, filters) in routes.items():
+			_endpoint.install(connections, filters)
+		self.retire(endpoints)
+
+		shards = set(_endpoint.shard for _endpoint in endpoints)
+		shards.discard(0)
+
+		if not shards:
+			self.stop()
+			self.router.update(endpoints)
+			return
+
+		self.number(endpoints)
+
+		keys = set()
+		for _endpoint in endpoints:
+			for target in _endpoint.connections:
+				if target.shard != _endpoint.shard:
+					keys.add((_endpoint.shard, target.shard))
+
+		# workers that are gone or run something else
+		signatures = dict((shard, self.signature(shard, endpoints, keys)) for shard in shards)
+		for shard in list(self.workers):
+			if signatures.get(shard) != self.workers[shard][0]:
+				self.halt(shard)
+
+		# only stopped workers used the rings that are not needed anymore
+		self.unwatch()
+		for key in list(self.rings):
+			if key not in keys:
+				self.rings.pop(key).close()
+		for key in keys:
+			if key not in self.rings:
+				self.rings[key] = Ring()
+
+		for shard in sorted(shards):
+			if shard in self.workers:
+				continue
+			print('starting shard %s') % shard
+			worker = multiprocessing.Process(target=work, args=(shard, endpoints, self.rings, self.numbers))
+			worker.daemon = True
+			worker.start()
+			self.workers[shard] = (signatures[shard], worker)
+
+		localize(0, endpoints, self.rings, self.numbers)
+		adopt([_endpoint for _endpoint in endpoints if _endpoint.shard == 0])
+		targets = dict((self.numbers[_endpoint.id], _endpoint) for _endpoint in endpoints
+					   if _endpoint.shard == 0)
+		for (source, target), ring in self.rings.items():
+			if target == 0:
+				self.router.watch(ring.fileno(), lambda ring=ring: deliver(ring, targets))
+				self.watched.append(ring)
+		self.router.update([_endpoint for _endpoint in endpoints if _endpoint.shard == 0])
+
+
+	# give the new endpoints the lowest free numbers, forget the removed ones
+	def number(self, endpoints):
+		ids = set(_endpoint.id for _endpoint in endpoints)
+		for endpoint_id in list(self.numbers):
+			if endpoint_id not in ids:
+				del self.numbers[endpoint_id]
+		used = set(self.numbers.values())
+		free = 0
+		for _endpoint in endpoints:
+			if _endpoint.id in self.numbers:
+				continue
+			while free in used:
+				free += 1
+			self.numbers[_endpoint.id] = free
+			used.add(free)
+
+
+	# everything a worker is started with: its endpoints (the very objects,
+	# their configuration and routes, with the mtu frames towards other
+	# shards are packed for) and the rings in and out of the shard.
+	# The worker has its own copy of all of it, it is restarted when this
+	# changes
+	def signature(self, shard, endpoints, keys):
+		signature = []
+		for _endpoint in endpoints:
+			if _endpoint.shard != shard:
+				continue
+			signature.append((id(_endpoint), self.numbers[_endpoint.id],
+							  json.dumps(_endpoint.to_json(), sort_keys=True),
+							  tuple((target.id, target.shard, self.numbers[target.id], target.mtu)
+									for target in _endpoint.connections),
+							  json.dumps(dict((target_id, _filter.settings)
+											  for target_id, _filter in _endpoint.filters.items()),
+										 sort_keys=True)))
+		rings = sorted(key for key in keys if shard in key)
+		return signature, rings
+
+
+	# close the endpoints that were removed, now that nothing routes to them
+	def retire(self, endpoints):
+		current = set(endpoints)
+		for _endpoint in self.endpoints:
+			if _endpoint in current:
+				continue
+			try:
+				_endpoint.close()
+			except Exception as e:
+				pass
+			endpoint.pending.discard(_endpoint)
+			endpoint.backlogged.discard(_endpoint)
+			endpoint.changed.discard(_endpoint)
+		self.endpoints = endpoints
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+
+import ctypes
+import mmap
+import os
+import struct
+import time
+
+# default bytes of shared memory in a ring
+RING_SIZE = 1 << 20
+
+# the head counter and the ring size at the start of the shared memory
+HEADER = struct.Struct('<QQ')
+COUNTER = struct.Struct('<Q')
+
+# every chunk is prefixed with its length
+RECORD = struct.Struct('<I')
+
+# length marking the end of the ring as unused, the next chunk is at 0
+WRAP = 0xFFFFFFFF
+
+# largest chunk published, a reader is lapped once it falls further behind
+# than the ring size minus this
+MAX_CHUNK = 65507
+
+
+# single producer, many consumers ring of chunks in a shared memory file
+# (/dev/shm/...). The router publishes and never waits on readers: the
+# oldest chunks are overwritten, and a reader that falls too far behind
+# skips ahead to the newest. Readers only look at the head counter, so
+# there is no system call per chunk on either side
+class Publisher(object):
+
+	def __init__(self, path, size=RING_SIZE):
+		self.path = path
+		self.size = size
+		fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+		try:
+			os.ftruncate(fd, HEADER.size + size)
+			self.memory = mmap.mmap(fd, HEADER.size + size)
+		finally:
+			os.close(fd)
+		self.view = memoryview((ctypes.c_char * (HEADER.size + size)).from_buffer(self.memory))
+		self.head = 0
+		HEADER.pack_into(self.memory, 0, 0, size)
+		# chunks too big to publish
+		self.drops = 0
+
+
+	def publish(self, data):
+		n = len(data)
+		if n > MAX_CHUNK:
+			self.drops += 1
+			return False
+
+		# chunks are never split, skip to the start if this one doesn't fit
+		position = self.head % self.size
+		if position + RECORD.size + n > self.size:
+			if self.size - position >= RECORD.size:
+				RECORD.pack_into(self.memory, HEADER.size + position, WRAP)
+			self.head += self.size - position
+			position = 0
+
+		start = HEADER.size + position
+		RECORD.pack_into(self.memory, start, n)
+		start += RECORD.size
+		self.view[start:start + n] = data
+
+		# publish
+		self.head += RECORD.size + n
+		COUNTER.pack_into(self.memory, 0, self.head)
+		return True
+
+
+	def close(self):
+		# the view holds on to the mapping
+		self.view = None
+		try:
+			self.memory.close()
+		except Exception as e:
+			pass
+
+
+# attach to a ring published by the router, for local consumers:
+#
+#	subscriber = shm.Subscriber('/dev/shm/mavlink')
+#	while True:
+#		for chunk in subscriber.wait():
+#			...
+class Subscriber(object):
+
+	def __init__(self, path):
+		fd = os.open(path, os.O_RDONLY)
+		try:
+			length = os.fstat(fd).st_size
+			self.memory = mmap.mmap(fd, length, access=mmap.ACCESS_READ)
+		finally:
+			os.close(fd)
+		head, self.size = HEADER.unpack_from(self.memory, 0)
+		# only what is published from now on
+		self.position = head
+		# bytes skipped because we fell behind
+		self.lost = 0
+
+
+	# the chunks published since the last call, as bytes
+	def read(self):
+		chunks = []
+		head = COUNTER.unpack_from(self.memory, 0)[0]
+		while self.position < head:
+			if head - self.position > self.size - MAX_CHUNK - RECORD.size:
+				self.lost += head - self.position
+				self.position = head
+				break
+
+			position = self.position % self.size
+			if self.size - position < RECORD.size:
+				self.position += self.size - position
+				continue
+
+			n = RECORD.unpack_from(self.memory, HEADER.size + position)[0]
+			if n == WRAP:
+				self.position += self.size - position
+				continue
+
+			start = HEADER.size + position + RECORD.size
+			chunk = self.memory[start:start + n]
+
+			# the publisher may have lapped us while we were copying
+			head = COUNTER.unpack_from(self.memory, 0)[0]
+			if head - self.position > self.size - MAX_CHUNK - RECORD.size:
+				continue
+
+			chunks.append(chunk)
+			self.position += RECORD.size + n
+		return chunks
+
+
+	# block until something is published, checking every interval seconds
+	def wait(self, interval=0.001):
+		while True:
+			chunks = self.read()
+			if chunks:
+				return chunks
+			time.sleep(interval)
+
+
+	def close(self):
+		self.memory.close()